@@ -0,0 +1,441 @@
+""" Benchmarks for class construction through class_helpers.
+
+    python bench.py                       # print results as JSON
+    python bench.py --save baseline.json  # store results as a baseline
+    python bench.py --compare baseline.json --tolerance 0.25
+
+    Comparing exits with status 1 when any benchmark is worse than the
+    baseline by more than the tolerance.  Throughput is measured as the
+    best of several repeats, so results are stable enough to compare
+    on the same machine.
+"""
+from class_helpers import patches, includes, inherits, metaclass
+from class_helpers import decorate, py2, py3, columnar, record, portable
+from class_helpers.profile import residue
+from collections import namedtuple
+from abc import ABCMeta
+from functools import wraps
+from timeit import default_timer
+import multiprocessing
+import subprocess
+import threading
+import argparse
+import operator
+import json
+import sys
+import os
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+NUMBER = 2000
+REPEAT = 5
+
+# (name, unit, higher_is_better, function)
+BENCHMARKS = []
+
+def benchmark(name, unit='classes/s', higher_is_better=True):
+    def register(func):
+        BENCHMARKS.append((name, unit, higher_is_better, func))
+        return func
+    return register
+
+def throughput(build, number=NUMBER, repeat=REPEAT):
+    """ Best classes per second over several repeats of build(i) """
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        for i in range(number):
+            build(i)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return number / best
+
+def make_mixin(depth, width=10, prefix='m'):
+    """ A chain of depth classes, each defining width attributes """
+    cls = object
+    for level in range(depth):
+        dct = dict(('%s%d_%d' % (prefix, level, i), i) for i in range(width))
+        cls = type('Level%d' % level, (cls,), dct)
+    return cls
+
+class A(object):
+    pass
+
+class B(object):
+    pass
+
+class Mixin(object):
+    x, y, z = 1, 2, 3
+    def method(self):
+        return self.x
+
+@benchmark('plain_class')
+def bench_plain_class():
+    return throughput(lambda i: type('Plain', (A,), {}))
+
+@benchmark('includes')
+def bench_includes():
+    return throughput(lambda i: type('Included', (A, includes(Mixin)), {}))
+
+@benchmark('includes_lazy')
+def bench_includes_lazy():
+    return throughput(lambda i: type('Lazy', (A, includes(Mixin, lazy=True)), {}))
+
+@benchmark('inherits')
+def bench_inherits():
+    return throughput(lambda i: type('Inherited', (inherits([A, B]),), {}))
+
+@benchmark('metaclass')
+def bench_metaclass():
+    return throughput(lambda i: type('Abstract', (A, metaclass(ABCMeta)), {}))
+
+@benchmark('patches')
+def bench_patches():
+    Patched = type('Patched', (object,), {})
+    return throughput(lambda i: type('Patched', (patches(Patched),), {'i': i}))
+
+@benchmark('decorate')
+def bench_decorate():
+    decorator = wraps(Mixin)
+    return throughput(lambda i: type('Decorated', (decorate(decorator),), {}))
+
+@benchmark('py3')
+def bench_py3():
+    def build(i):
+        surrogate = py3(A, B, metaclass=ABCMeta, includes=Mixin)
+        return type('Py3', (surrogate,), {})
+    return throughput(build)
+
+@benchmark('py2')
+def bench_py2():
+    def build(i):
+        surrogate = py2(A, B, includes=Mixin)
+        return type('Py2', (surrogate,), {'__metaclass__': ABCMeta})
+    return throughput(build)
+
+def register_scaling():
+    for count in (1, 4, 16):
+        mixins = [make_mixin(1, prefix='c%d_' % n) for n in range(count)]
+        def bench(mixins=mixins):
+            return throughput(lambda i: type('Many', (includes(mixins),), {}))
+        benchmark('includes_mixins_%d' % count)(bench)
+    for depth in (1, 4, 16):
+        mixin = make_mixin(depth)
+        def bench(mixin=mixin):
+            return throughput(lambda i: type('Deep', (includes(mixin),), {}))
+        benchmark('includes_depth_%d' % depth)(bench)
+
+register_scaling()
+
+def threaded_throughput(build, threads, number=NUMBER // 4, repeat=REPEAT):
+    """ Best total classes per second with each thread running build(i)
+        number times, all threads starting together.
+    """
+    best = None
+    for _ in range(repeat):
+        ready = threading.Event()
+        def work():
+            ready.wait()
+            for i in range(number):
+                build(i)
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        start = default_timer()
+        ready.set()
+        for worker in workers:
+            worker.join()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return threads * number / best
+
+def register_threads():
+    def build(i):
+        surrogate = py3(A, B, metaclass=ABCMeta, includes=Mixin)
+        return type('Threaded', (surrogate,), {})
+    for threads in (1, 2, 4, 8):
+        def bench(threads=threads):
+            return threaded_throughput(build, threads)
+        benchmark('py3_threads_%d' % threads)(bench)
+
+register_threads()
+
+@benchmark('surrogate_bytes', unit='bytes', higher_is_better=False)
+def bench_surrogate_bytes(number=1000):
+    """ Memory held per freshly built surrogate """
+    if tracemalloc is None:
+        return None
+    decorators = [wraps(Mixin) for _ in range(number)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        surrogates = [decorate(decorator) for decorator in decorators]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del surrogates
+    return (after - before) / float(number)
+
+ROWS = 100000
+
+Sample = namedtuple('Sample', ('x', 'y', 'weight'))
+Samples = columnar(Sample, {'x': 'd', 'y': 'd', 'weight': 'l'})
+
+def make_samples(number=ROWS):
+    return [Sample(i * 0.5, -i * 0.25, i % 7) for i in range(number)]
+
+def traced_bytes(build):
+    """ Bytes still allocated after build(), per row """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        built = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del built
+    return (after - before) / float(ROWS)
+
+@benchmark('rows_list_bytes', unit='bytes/row', higher_is_better=False)
+def bench_rows_list_bytes():
+    return traced_bytes(make_samples)
+
+@benchmark('rows_columnar_bytes', unit='bytes/row', higher_is_better=False)
+def bench_rows_columnar_bytes():
+    rows = make_samples()
+    return traced_bytes(lambda: Samples(rows))
+
+def aggregate_throughput(total, repeat=REPEAT):
+    """ Best rows per second of total(), which sums x * weight """
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        total()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return ROWS / best
+
+@benchmark('rows_list_sum', unit='rows/s')
+def bench_rows_list_sum():
+    rows = make_samples()
+    return aggregate_throughput(lambda: sum(row.x * row.weight for row in rows))
+
+@benchmark('rows_columnar_sum', unit='rows/s')
+def bench_rows_columnar_sum():
+    table = Samples(make_samples())
+    return aggregate_throughput(lambda: sum(map(operator.mul, table.x, table.weight)))
+
+@benchmark('rows_numpy_sum', unit='rows/s')
+def bench_rows_numpy_sum():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    table = Samples(make_samples())
+    def total():
+        x = table.column('x', numpy=True)
+        return x.dot(table.column('weight', numpy=True))
+    return aggregate_throughput(total)
+
+class HandPerson(object):
+    """ The hand written equivalent, as in test.py's BasePerson """
+    def __init__(self, *args):
+        self.args = args
+    @property
+    def first_name(self):
+        return self.args[0]
+    @property
+    def last_name(self):
+        return self.args[1]
+
+TuplePerson = namedtuple('TuplePerson', ('first_name', 'last_name'))
+
+class RecordPerson(record(['first_name', 'last_name'])):
+    pass
+
+PEOPLE = (('hand', HandPerson), ('namedtuple', TuplePerson), ('record', RecordPerson))
+
+def operations(run, number=NUMBER * 50, repeat=REPEAT):
+    """ Best operations per second of run(number) """
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        run(number)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return number / best
+
+def register_records():
+    for label, cls in PEOPLE:
+        def bench_init(cls=cls):
+            def run(number):
+                for i in range(number):
+                    cls('Steve', 'Zelaznik')
+            return operations(run)
+        benchmark('%s_person_init' % label, unit='objects/s')(bench_init)
+        def bench_access(cls=cls):
+            person = cls('Steve', 'Zelaznik')
+            def run(number):
+                for i in range(number):
+                    person.first_name
+                    person.last_name
+            return operations(run)
+        benchmark('%s_person_access' % label, unit='objects/s')(bench_access)
+
+register_records()
+
+TRANSFERS = 20000
+CHUNK = 500
+
+def make_point(label):
+    """ A class built at run time, which pickle cannot import by name """
+    return type('Point', (portable(), includes(Mixin)), {'label': label})
+
+Point = make_point('bench')
+
+def total_points(points):
+    return sum(point.value * point.x for point in points)
+
+def total_dicts(rows):
+    return sum(row['value'] for row in rows)
+
+def transfer_throughput(work, items, repeat=REPEAT):
+    """ Best objects per second sent to a process pool and used there """
+    chunks = [items[i:i + CHUNK] for i in range(0, len(items), CHUNK)]
+    best = None
+    pool = multiprocessing.Pool(2)
+    try:
+        # Start the workers before timing
+        pool.map(work, chunks[:2])
+        for _ in range(repeat):
+            start = default_timer()
+            pool.map(work, chunks)
+            elapsed = default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        pool.close()
+        pool.join()
+    return len(items) / best
+
+def make_points():
+    points = []
+    for i in range(TRANSFERS):
+        point = Point()
+        point.value = i
+        points.append(point)
+    return points
+
+@benchmark('pool_portable_transfer', unit='objects/s')
+def bench_pool_portable_transfer():
+    return transfer_throughput(total_points, make_points())
+
+@benchmark('pool_dict_transfer', unit='objects/s')
+def bench_pool_dict_transfer():
+    """ Converting to dicts, as unportable instances had to be """
+    return transfer_throughput(total_dicts, [vars(point) for point in make_points()])
+
+def register_residue():
+    """ Bytes each class built and thrown away leaves behind, which
+        should stay at zero however many are built.
+    """
+    target = type('Target', (object,), {})
+    builds = {
+        'includes': lambda i: type('Included', (A, includes(make_mixin(1))), {}),
+        'patches': lambda i: type('Target', (patches(target),), {'i': i}),
+        'decorate': lambda i: type('Decorated', (decorate(wraps(Mixin)),), {}),
+        'py6': lambda i: type('Py3', (py3(A, B, metaclass=ABCMeta, includes=Mixin),), {}),
+    }
+    for name, build in sorted(builds.items()):
+        def bench(build=build):
+            found = residue(build)
+            if found['bytes'] is None:
+                return None
+            # Whole bytes, so noise around zero is not a regression
+            return round(max(found['bytes'], 0))
+        benchmark('%s_residue_bytes' % name, unit='bytes/class',
+                  higher_is_better=False)(bench)
+
+register_residue()
+
+@benchmark('import_seconds', unit='seconds', higher_is_better=False)
+def bench_import_seconds(repeat=REPEAT):
+    """ Best wall time of 'import class_helpers' in a fresh interpreter """
+    code = ('from timeit import default_timer\n'
+            'start = default_timer()\n'
+            'import class_helpers\n'
+            'print(default_timer() - start)\n')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=cwd)
+        times.append(float(output.decode().strip()))
+    return min(times)
+
+def run(selected=None):
+    results = {}
+    for name, unit, higher_is_better, func in BENCHMARKS:
+        if selected and name not in selected:
+            continue
+        value = func()
+        if value is not None:
+            results[name] = {'unit': unit, 'value': round(value, 9),
+                             'higher_is_better': higher_is_better}
+    # Free-threaded builds report whether the GIL is actually enabled
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    return {'python': sys.version.split()[0], 'gil': gil, 'results': results}
+
+def compare(current, baseline, tolerance):
+    """ Returns (name, baseline value, current value) regressions """
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        old, new = base['value'], result['value']
+        if result['higher_is_better']:
+            worse = new < old * (1 - tolerance)
+        else:
+            worse = new > old * (1 + tolerance)
+        if worse:
+            regressions.append((name, old, new))
+    return regressions
+
+def dump(data, path=None):
+    text = json.dumps(data, indent=2, sort_keys=True)
+    if path is None:
+        print(text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', help='benchmarks to run')
+    parser.add_argument('--save', metavar='PATH', help='write results to PATH')
+    parser.add_argument('--compare', metavar='PATH', help='baseline to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    current = run(args.names)
+    dump(current, args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        for name, old, new in regressions:
+            sys.stderr.write('REGRESSION %s: %s -> %s\n' % (name, old, new))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,27 +4,140 @@
 
     Works for standard classes (instances of 'type')
     and abstract base classes (instances of abc.ABCMeta)
+
+    Classes may be built concurrently from any number of threads.  The
+    internal caches are plain dicts whose races are benign: threads may
+    duplicate work, but only one result is ever kept.  Patching and the
+    instrumentation counters take locks.
 """
-__all__ = ['class_helper_meta','patches','includes','inherits','metaclass','py3','decorate']
+__all__ = ['class_helper_meta','patches','includes','inherits','metaclass','py3','decorate',
+           'build_classes','enable_instrumentation','disable_instrumentation',
+           'instrumentation_snapshot','add_construction_hook','remove_construction_hook',
+           'materialize','patch_set','slots','flatten','reflatten',
+           'memoize','cache_info','invalidate','columnar',
+           'propagate','lazy','force','force_all',
+           'class_cache','cached_class','finalize','record','hot_reload','portable']
 
 from abc import ABCMeta
+from operator import attrgetter, itemgetter
+from collections import OrderedDict
+from functools import wraps, partial
+import threading
+import keyword
+import types
+import array
+import weakref
+import gc
+import sys
+from timeit import default_timer
+try:
+    from sys import intern
+except ImportError:  # Python 2, where intern is a builtin
+    pass
+
+# Surrogates already built by _wrap, keyed on (metaclass, helper name,
+# solo, ids of the arguments).  Surrogates hold their arguments, so the
+# ids stay unique while an entry exists, and entries go as soon as
+# nothing else uses the surrogate.
+_interned = weakref.WeakValueDictionary()
+
+# Attribute layouts of included mixins, keyed on the id of the mixin.
+# Plans store attribute names and MRO positions only, never values,
+# so they cannot keep the mixin alive.  Each plan is a tuple of
+# (weakref, MRO ids, per-base key snapshot, {key: owning MRO index},
+#  MRO indices supplying values, names lazy includes copy at once, frozenset of
+#  every name, slot names, names never copied).
+_mixin_plans = {}
+
+# Flattened handle_surrogates work, keyed on the metaclass and the
+# _shape of each surrogate, so one plan serves every combination of
+# the same helpers no matter what they were given.
+_construction_plans = {}
+_get_shape = attrgetter('_shape')
+
+# Every _shape in use, so surrogates of the same shape share one tuple
+_shapes = {}
+
+# Helpers which only rewrite the class body, so they may accompany the
+# solo helpers
+_body_helpers = frozenset(('memoize', 'record'))
+
+# Per-class descriptors and bookkeeping which must never be copied onto
+# another class
+_class_slots = frozenset(('__dict__', '__weakref__', '__flattened__', '__included__',
+                          '__portable__'))
+
 class class_helper_meta(ABCMeta):
     @classmethod
-    def _wrap(mcls, name, value_or_array, **dct):
-        dct['solo'] = dct.get('solo', False)
-        dct['name'] = name
-
+    def _wrap(mcls, name, value_or_array, solo=False, **dct):
         # Args is either a single value, or an array of values
         try:
-            dct['args'] = tuple(value_or_array)
+            args = tuple(value_or_array)
         except TypeError:
-            dct['args'] = (value_or_array,)
+            args = (value_or_array,)
+
+        key = mcls._intern_key(name, solo, args, dct)
+        if key is not None:
+            surrogate = _interned.get(key)
+            if surrogate is None:
+                surrogate = mcls._surrogate(name, solo, args, {'args': args})
+                # Threads racing to intern the same arguments all get the winner
+                surrogate = _interned.setdefault(key, surrogate)
+            return surrogate
+
+        dct['args'] = args
+        return mcls._surrogate(name, solo, args, dct)
 
-        cls_name = '%s_surrogate' % name
-        surrogate = type.__new__(mcls, cls_name, (), dct)
-        return surrogate
+    @classmethod
+    def _surrogate(mcls, name, solo, args, dct):
+        """ Surrogates are thrown away after one class statement, so they
+            are made as small as a class can be.  __slots__ spares them an
+            instance layout, type.__new__ skips the ABC registry and cache
+            state, and name and solo live in the shared _shape tuple.
+        """
+        dct['__slots__'] = ()
+        dct['_shape'] = mcls._shape_of(name, solo, args)
+        return type.__new__(mcls, intern('%s_surrogate' % name), (), dct)
+
+    @classmethod
+    def _intern_key(mcls, name, solo, args, dct):
+        """ Only surrogates whose arguments are all classes are interned,
+            other arguments (e.g. decorators) tend to be temporaries.
+        """
+        if dct:
+            return None
+        for arg in args:
+            if not isinstance(arg, type):
+                return None
+        return (mcls, name, solo, tuple(map(id, args)))
+
+    @staticmethod
+    def _shape_of(name, solo, args):
+        """ Everything a construction plan depends on, which excludes
+            the values of the arguments themselves.  Equal shapes are
+            shared between surrogates.
+        """
+        inner = ()
+        if name == 'py6':
+            inner = tuple(arg._shape for arg in args)
+        shape = (name, solo, inner)
+        return _shapes.setdefault(shape, shape)
+
+    @property
+    def name(self):
+        return self._shape[0]
+
+    @property
+    def solo(self):
+        return self._shape[1]
+
+    # The patch_set collecting changes from patches(..., into=...)
+    _target = None
 
     def __new__(mcls, name, surrogates_or_bases, dct):
+        monitor = _monitor
+        if monitor is not None:
+            start = monitor.before(name, surrogates_or_bases, dct)
         bases = []
         surrogates = []
         params = {'name': name, 'dct': dct}
@@ -36,57 +149,385 @@ class class_helper_meta(ABCMeta):
         bases = params['bases'] = tuple(bases)
         surrogates = tuple(surrogates)
         mcls.handle_surrogates(surrogates, params)
+        cls = mcls._build(params)
+        if monitor is not None:
+            monitor.after(cls, start)
+        return cls
 
+    @staticmethod
+    def _build(params):
+        for prepare in params.get('preparers', ()):
+            prepare(params)
+        dct = params['dct']
         if 'cls' in params:
-            cls = params['cls']
-        else:
-            _mcls_ = '__metaclass__'
-            if (_mcls_ in params) and (_mcls_ in dct):
-                raise TypeError("The metaclass can only be declared in one place.")
-            meta = params.get(_mcls_) or dct.get(_mcls_) or type
-            bases = params.get('bases', ())
-            name = params['name']
-            cls = meta(name, bases, dct)
-
+            cls, target = params['cls'], params['patch_into']
+            if target is None:
+                _apply_patches([(cls, dct)])
+            else:
+                target.add(cls, dct)
+            return cls
+        _mcls_ = '__metaclass__'
+        if (_mcls_ in params) and (_mcls_ in dct):
+            raise TypeError("The metaclass can only be declared in one place.")
+        meta = params.get(_mcls_) or dct.get(_mcls_) or type
+        bases = params.get('bases', ())
+        name = params['name']
+        cls = meta(name, bases, dct)
+        for finalize in params.get('finalizers', ()):
+            finalize(cls)
         return cls
 
+    @classmethod
+    def build_many(mcls, specs):
+        """ Builds a class for each (name, bases, helpers, dct) spec.
+            Combinations of includes, inherits, metaclass and py6 are
+            resolved once per batch and shared by every spec using the
+            same helper objects.  Specs using patches or decorate are
+            handled one at a time, exactly like a class statement.
+        """
+        shared = {}
+        classes = []
+        for name, bases, helpers, dct in specs:
+            helpers = tuple(helpers)
+            bases = tuple(bases)
+            monitor = _monitor
+            if monitor is not None:
+                start = monitor.before(name, bases + helpers, dct)
+            params = {'name': name, 'dct': dct, 'bases': bases}
+            key = tuple(map(id, helpers))
+            if key not in shared:
+                # Keep the helpers alive so their ids stay unique
+                shared[key] = (helpers, mcls._resolve_shared(helpers))
+            resolved = shared[key][1]
+            if resolved is None:
+                mcls.handle_surrogates(helpers, params)
+            else:
+                included, inherited, meta = resolved
+                if inherited is not None:
+                    if params['bases']:
+                        raise TypeError("Inconsistent base class layouts.")
+                    params['bases'] = inherited
+                if meta is not None:
+                    params['__metaclass__'] = meta
+                dct.update(included)
+            cls = mcls._build(params)
+            if monitor is not None:
+                monitor.after(cls, start)
+            classes.append(cls)
+        return classes
+
+    @classmethod
+    def _resolve_shared(mcls, helpers):
+        """ Returns (included attributes, inherited bases, metaclass)
+            for helpers whose result does not depend on the class body,
+            or None when any helper needs the individual class.
+        """
+        if not all(map(mcls._is_shareable, helpers)):
+            return None
+        params = {'name': None, 'dct': {}, 'bases': None}
+        mcls.handle_surrogates(helpers, params)
+        return (params['dct'], params['bases'], params.get('__metaclass__'))
+
+    @classmethod
+    def _is_shareable(mcls, surrogate):
+        if surrogate.name == 'py6':
+            return all(map(mcls._is_shareable, surrogate.args))
+        return surrogate.name in ('includes', 'inherits', 'metaclass')
+
     @classmethod
     def handle_surrogates(mcls, surrogates, params):
+        key = (mcls,) + tuple(map(_get_shape, surrogates))
+        plan = _construction_plans.get(key)
+        if plan is None:
+            plan = _construction_plans[key] = mcls._compile(surrogates)
+        expansions, steps = plan
+        frames = [surrogates]
+        for frame, index in expansions:
+            frames.append(frames[frame][index].args)
+        monitor = _monitor
+        if monitor is None:
+            for func, frame, index in steps:
+                func(frames[frame][index], params)
+        else:
+            # Helpers given through py6 also count towards py6 itself
+            py6 = 0.0
+            for func, frame, index in steps:
+                start = default_timer()
+                func(frames[frame][index], params)
+                elapsed = monitor.record(func, start)
+                if frame:
+                    py6 += elapsed
+            if expansions:
+                monitor.add('py6', py6)
+
+    @classmethod
+    def _compile(mcls, surrogates):
+        """ Flattens surrogates into a plan of (expansions, steps).
+
+            handle_surrogates keeps a list of frames, starting with
+            the surrogates themselves.  Each (frame, index) expansion
+            appends the args of the py6 found there as a new frame.
+            Each (func, frame, index) step then calls an _unwrap_*
+            function on the surrogate found there.
+        """
+        expansions, steps = [], []
+        mcls._compile_frame(surrogates, 0, expansions, steps)
+        return tuple(expansions), tuple(steps)
+
+    @classmethod
+    def _compile_frame(mcls, surrogates, frame, expansions, steps):
         # Go backward in the event of multiple mixins
         # That was the FIRST mixin is what is most recently
         # Upated to the attributes dictionary
-        for surrogate in reversed(surrogates):
+        for index in reversed(range(len(surrogates))):
+            surrogate = surrogates[index]
             if surrogate.solo:
-                if len(surrogates) > 1:
+                others = [other for other in surrogates
+                          if other.name not in _body_helpers]
+                if len(others) > 1:
                     msg = "Cannot combine %s with any other helpers"
                     raise TypeError(msg % (surrogate,))
-            func = getattr(mcls, '_unwrap_%s' % surrogate.name)
-            func(surrogate, params)
+            if surrogate.name == 'py6':
+                expansions.append((frame, index))
+                inner = len(expansions)
+                mcls._compile_frame(surrogate.args, inner, expansions, steps)
+            else:
+                func = getattr(mcls, '_unwrap_%s' % surrogate.name)
+                # The plain function, since surrogates of a base metaclass
+                # are not instances of mcls, which Python 2 methods require
+                func = getattr(func, '__func__', func)
+                steps.append((func, frame, index))
 
     def _unwrap_py6(self, params):
         self.handle_surrogates(self.args, params)
 
     def _unwrap_includes(self, params):
         dct = params['dct']
+        slots = params.setdefault('included_slots', [])
         for module in reversed(self.args):
-            for base in module.__mro__:
-                if base is object:
-                    continue
-                items = base.__dict__.items()
-                for key, value in items:
-                    dct[key] = value
+            merged = self._resolve_mixin(module, slots)
+            if _monitor is not None:
+                _monitor.count('includes_attributes', len(merged))
+            dct.update(merged)
+
+    @classmethod
+    def _resolve_mixin(mcls, module, slots=None):
+        """ Returns a fresh dict of the attributes a mixin contributes.
+            Values are always read from the live class dicts, only the
+            layout (which bases supply the final values) is cached.
+
+            Slots describe the mixin's own instance layout, so neither
+            __slots__ nor slot descriptors are copied.  Their names are
+            appended to slots instead, for the slots() helper to use.
+        """
+        mro = module.__mro__
+        plan = mcls._current_plan(module, mro)
+        merged = plan[3].copy()
+        for index in plan[4]:
+            merged.update(mro[index].__dict__.copy())
+        for key in plan[8]:
+            merged.pop(key, None)
+        if slots is not None:
+            slots.extend(plan[7])
+        return merged
+
+    @classmethod
+    def _current_plan(mcls, module, mro):
+        plan = _mixin_plans.get(id(module))
+        if plan is None or not mcls._plan_is_current(plan, mro):
+            plan = mcls._plan_mixin(module, mro)
+        return plan
+
+    @classmethod
+    def _lookup_mixins(mcls, mixins, key):
+        """ The value includes would copy for key, or _missing """
+        plans = [(module.__mro__, mcls._current_plan(module, module.__mro__))
+                 for module in mixins]
+        return mcls._lookup_plans(plans, key)
+
+    @staticmethod
+    def _lookup_plans(plans, key):
+        for mro, plan in plans:
+            index = plan[3].get(key)
+            if index is not None:
+                return mro[index].__dict__[key]
+        return _missing
+
+    @staticmethod
+    def _plan_is_current(plan, mro):
+        if plan[1] != tuple(map(id, mro)):
+            return False
+        for base, keys in zip(mro, plan[2]):
+            if tuple(base.__dict__) != keys:
+                return False
+        return True
+
+    @classmethod
+    def _plan_mixin(mcls, module, mro):
+        layout = tuple(tuple(base.__dict__) for base in mro)
+        owners, indices, eager, slot_names = mcls._lay_out_mixin(mro)
+        excluded = tuple(_class_slots) + ('__slots__',) + slot_names
+
+        def evict(ref, key=id(module)):
+            _mixin_plans.pop(key, None)
+        ref = weakref.ref(module, evict)
+        plan = (ref, tuple(map(id, mro)), layout, owners, indices, eager,
+                frozenset(owners), slot_names, excluded)
+        _mixin_plans[id(module)] = plan
+        return plan
+
+    @staticmethod
+    def _lay_out_mixin(mro):
+        # Later classes in the MRO overwrite earlier ones, while each key
+        # keeps the position where it first appeared.  Bases whose
+        # attributes are all overwritten are left out of the plan.
+        owners = {}
+        slot_names = []
+        for index, base in enumerate(mro):
+            if base is object:
+                continue
+            own_slots = _slot_names(base)
+            slot_names.extend(own_slots)
+            for key in base.__dict__:
+                if key not in _class_slots and key != '__slots__' and key not in own_slots:
+                    owners[key] = index
+        indices = tuple(sorted(set(owners.values())))
+        # Copied at once by lazy includes: special methods, and the class
+        # level methods which are usually called on the class itself
+        eager = tuple(key for key, index in owners.items() if _is_special(key)
+                      or isinstance(mro[index].__dict__[key], (classmethod, staticmethod)))
+        return owners, indices, eager, tuple(slot_names)
+
+    def _unwrap_flatten(self, params):
+        global _flattening
+        _flattening = True
+        names = self.args
+        def finalize(cls):
+            _flatten(cls, names)
+        params.setdefault('finalizers', []).append(finalize)
+
+    def _unwrap_memoize(self, params):
+        ''' The named methods and properties are wrapped just before the
+            class is created or patched, once the body is final.
+        '''
+        names, maxsize, ttl = self.args, self.maxsize, self.ttl
+        def prepare(params):
+            global _memoizing
+            _memoizing = True
+            dct = params['dct']
+            for name in names:
+                value = dct.get(name, _missing)
+                if value is _missing:
+                    value = _inherited_attribute(params, name)
+                dct[name] = _memoized(value, _memo_cache(maxsize, ttl))
+            # Last, once slots() has settled the __slots__
+            params['preparers'].append(_weakref_slot)
+        params.setdefault('preparers', []).append(prepare)
+
+    def _unwrap_record(self, params):
+        ''' The methods are generated just before the class is created,
+            so anything the body, includes or patches define wins.
+        '''
+        fields = self.args
+        _record_code(fields)
+        def prepare(params):
+            _prepare_record(params, fields)
+        params.setdefault('preparers', []).append(prepare)
+
+    def _unwrap_portable(self, params):
+        ''' Instances pickle through _portable_reduce, unless the body
+            reduces them its own way.  _portable_meta records the spec.
+        '''
+        dct = params['dct']
+        if '__reduce__' not in dct and '__reduce_ex__' not in dct:
+            dct['__reduce_ex__'] = _portable_reduce
+
+    def _unwrap_slots(self, params):
+        ''' The __slots__ are merged just before the class is created,
+            once every other helper has settled the bases and the body.
+        '''
+        extra = self.args
+        def prepare(params):
+            params['dct']['__slots__'] = _merge_slots(params, extra)
+        params.setdefault('preparers', []).append(prepare)
+
+    def _unwrap_lazy_includes(self, params):
+        ''' Copies only what cannot wait: special methods, which the
+            interpreter looks up on the type directly, classmethods and
+            staticmethods, which are called on the class, and names which
+            the class body or its bases also define.  Everything else is
+            copied into the class by a __getattr__ hook on first lookup.
+        '''
+        dct = params['dct']
+        mixins = self.args
+        plans = [(module.__mro__, self._current_plan(module, module.__mro__))
+                 for module in mixins]
+        if len(plans) == 1:
+            keys = plans[0][1][6]
+        else:
+            keys = frozenset().union(*[plan[6] for mro, plan in plans])
+        eager = set(keys.intersection(dct))
+        for mro, plan in plans:
+            eager.update(plan[5])
+        for key in eager:
+            dct[key] = self._lookup_plans(plans, key)
+        if _monitor is not None:
+            _monitor.count('includes_attributes', len(eager))
+
+        # The pending names are shared with the plan where possible, the
+        # hook skips any name already present in the class dict.
+        hook = _lazy_getattr(mixins, keys, dct.get('__getattr__'))
+        dct['__getattr__'] = hook
+
+        def prepare(params):
+            # Names the bases define would never reach the hook, and
+            # ABCMeta must see them to work out __abstractmethods__
+            dct = params['dct']
+            inherited = set()
+            for base in params.get('bases', ()):
+                for klass in base.__mro__:
+                    inherited.update(klass.__dict__)
+            pending = hook.lazy_includes['pending'].intersection(inherited)
+            for key in pending.difference(dct):
+                dct[key] = self._lookup_mixins(mixins, key)
+        params.setdefault('preparers', []).append(prepare)
+
+        if _subclass_hooks and '__init_subclass__' not in dct:
+            # super() never calls __getattr__, so subclasses get every
+            # pending name copied first
+            def __init_subclass__(subclass, **kwargs):
+                materialize(subclass)
+                owner = hook.lazy_includes['owner']
+                super(owner, subclass).__init_subclass__(**kwargs)
+            dct['__init_subclass__'] = classmethod(__init_subclass__)
+
+        def finalize(cls):
+            hook.lazy_includes['owner'] = cls
+        params.setdefault('finalizers', []).append(finalize)
+
+    def _unwrap_tracked_includes(self, params):
+        ''' Includes the mixins as usual, then registers the class as
+            their consumer so later changes can be pushed into it.
+        '''
+        global _tracking
+        _tracking = True
+        self._unwrap_includes(params)
+        mixins = self.args
+        def finalize(cls):
+            _track_includes(cls, mixins)
+        params.setdefault('finalizers', []).append(finalize)
 
     def _unwrap_patches(self, params):
-        name, dct = params['name'], params['dct']
+        name = params['name']
         (cls,) = self.args
         if cls.__name__ != name:
             msg = """Inconsistent naming orig=%s, new=%s"""
             raise TypeError(msg % (cls.__name__, name))
         if params['bases']:
             raise TypeError("Cannot alter inheritance of pre-existing class.")
-        for key, value in dct.items():
-            setattr(cls, key, value)
+        # _build applies the patch once the body is final
         params['cls'] = cls
+        params['patch_into'] = self._target
 
     def _unwrap_metaclass(self, params):
         (mcls,) = self.args
@@ -99,57 +540,1559 @@ class class_helper_meta(ABCMeta):
         params['bases'] = self.args
 
     def _unwrap_decorate(self, params):
-        ''' We create a mock object which behaves like the class.
-            Once the class decorator updates the attributes on the 
-            mock object, we then merge its __dict__ with params['dct']
+        ''' We create a namespace object which behaves like the class.
+            The class decorators record their changes in its journal,
+            which is then merged with params['dct'] in a single pass.
         '''
+        namespace = _journal_namespace(params)
         for decorate in reversed(self.args):
-            dct = params['dct']
-            setter = object.__setattr__
-            getter = object.__getattribute__.__call__
-            class Mock(object):
-                __slots__ = ('d',)
-                def __init__(self):
-                    setter(self, 'd', {})
-
-                def __repr__(self):
-                    name = getter(self, '__class__').__name__
-                    dct = getter(self, 'd')
-                    return '%s(%r)' % (name, dct)
-
-                def __setattr__(self, key, value):
-                    if key == '__name__':
-                        params['name'] = value
-                    else:
-                        d = getter(self, 'd')
-                        d[key] = value
-
-                def __getattribute__(self, key):
-                    try:
-                        return getter(self, 'd')[key]
-                    except KeyError:
-                        return getter(self, key)
-
-                @property
-                def __dict__(self):
-                    return getter(self, 'd').copy()
-
-            mock = Mock()
-            old = dict(mock.__dict__)
-            decorate(mock)
-            new = dict(mock.__dict__)
-
-            dual = set(new) & set(old)
-            deleted_keys = set(old) - set(new)
-            created_keys = set(new) - set(old)
-            changed_keys = {k for k in dual if new[k] != old[k]}
-
-            for key in (deleted_keys & set(dct)):
-                del dct[key]
-            for key in (created_keys | changed_keys):
-                dct[key] = new[key]
-
-def patches(value_or_array):
+            decorate(namespace)
+        _journal_namespace.merge(namespace)
+
+_missing = object()
+_deleted = object()
+
+# Whether classes are told about their subclasses, Python 3.6 and later
+_subclass_hooks = hasattr(object, '__init_subclass__')
+
+_setter = object.__setattr__
+_getter = object.__getattribute__
+
+class _journal_namespace(object):
+    """ Stands in for the class being decorated.  Reads see earlier
+        writes, then the class body.  Writes and deletes are journaled
+        rather than applied, so merging costs O(changes made).
+    """
+    __slots__ = ('_params', '_journal')
+
+    def __init__(self, params):
+        _setter(self, '_params', params)
+        _setter(self, '_journal', {})
+
+    def __repr__(self):
+        name = _getter(self, '__class__').__name__
+        journal = _getter(self, '_journal')
+        return '%s(%r)' % (name, journal)
+
+    def __setattr__(self, key, value):
+        params = _getter(self, '_params')
+        if key == '__name__':
+            params['name'] = value
+            return
+        journal = _getter(self, '_journal')
+        if key not in journal and params['dct'].get(key, _missing) is value:
+            return
+        journal[key] = value
+
+    def __delattr__(self, key):
+        journal = _getter(self, '_journal')
+        value = journal.get(key, _missing)
+        if value is _missing:
+            value = _getter(self, '_params')['dct'].get(key, _missing)
+        if value is _missing or value is _deleted:
+            raise AttributeError(key)
+        journal[key] = _deleted
+
+    def __getattribute__(self, key):
+        value = _getter(self, '_journal').get(key, _missing)
+        if value is _deleted:
+            raise AttributeError(key)
+        if value is not _missing:
+            return value
+        params = _getter(self, '_params')
+        if key == '__name__':
+            return params['name']
+        value = params['dct'].get(key, _missing)
+        if value is not _missing:
+            return value
+        return _getter(self, key)
+
+    @property
+    def __dict__(self):
+        dct = dict(_getter(self, '_params')['dct'])
+        for key, value in _getter(self, '_journal').items():
+            if value is _deleted:
+                dct.pop(key, None)
+            else:
+                dct[key] = value
+        return dct
+
+    @staticmethod
+    def merge(namespace):
+        dct = _getter(namespace, '_params')['dct']
+        for key, value in _getter(namespace, '_journal').items():
+            if value is _deleted:
+                dct.pop(key, None)
+            else:
+                dct[key] = value
+
+# Serialises patch_set transactions against each other
+_patch_lock = threading.RLock()
+
+def _apply_patches(changes):
+    """ Writes [(cls, {key: value})] changes, returning the undo journal
+        as [(cls, key, previous value or _missing)].
+
+        Patches are applied one at a time, and the previous values are
+        read under the same lock, so concurrent patches never record
+        each other's half written state.  Threads reading the classes
+        meanwhile may still see some writes before others.  If any write
+        fails, those already made are undone before re-raising.
+    """
+    with _patch_lock:
+        undo, writes = [], []
+        for cls, dct in changes:
+            current = cls.__dict__
+            for key, value in dct.items():
+                undo.append((cls, key, current.get(key, _missing)))
+                writes.append((cls, key, value))
+        for index, (cls, key, value) in enumerate(writes):
+            try:
+                setattr(cls, key, value)
+            except BaseException:
+                _revert_patches(undo[:index])
+                raise
+        _after_patching(writes)
+    if _monitor is not None:
+        _monitor.count('patches_setattrs', len(writes))
+    return undo
+
+def _revert_patches(undo):
+    """ Restores an undo journal from _apply_patches, newest first """
+    with _patch_lock:
+        for cls, key, previous in reversed(undo):
+            if previous is _missing:
+                if key in cls.__dict__:
+                    delattr(cls, key)
+            else:
+                setattr(cls, key, previous)
+        _after_patching(undo)
+
+def _after_patching(writes):
+    """ Brings everything derived from the patched classes up to date,
+        given the (cls, key, value) writes made to them.
+    """
+    changed = {}
+    for cls, key, value in writes:
+        changed.setdefault(cls, set()).add(key)
+    if _tracking:
+        _push_mixin_changes(changed)
+    if _flattening:
+        _reflatten_subclasses(changed)
+    if _memoizing:
+        _forget_patched(changed)
+
+# Tracked mixins, each mapped to a WeakSet of the classes which included
+# it with includes(..., track=True).  Each of those classes keeps its
+# mixins, and the values it was given, in its __included__ dict.
+_consumers = weakref.WeakKeyDictionary()
+
+# Set once includes(..., track=True) is first used
+_tracking = False
+
+def _track_includes(cls, mixins):
+    """ Registers cls as a consumer of mixins, recording the values it
+        actually took from them so later overrides can be told apart.
+    """
+    with _patch_lock:
+        state = cls.__dict__.get('__included__')
+        if state is None:
+            state = {'mixins': (), 'copies': {}}
+            setattr(cls, '__included__', state)
+        # Later finalizers belong to helpers further left, which win
+        state['mixins'] = tuple(mixins) + state['mixins']
+        own = cls.__dict__
+        for key in frozenset().union(*[_mixin_keys(mixin) for mixin in mixins]):
+            value = class_helper_meta._lookup_mixins(state['mixins'], key)
+            if value is not _missing and own.get(key, _missing) is value:
+                state['copies'][key] = value
+        for mixin in mixins:
+            consumers = _consumers.get(mixin)
+            if consumers is None:
+                consumers = _consumers[mixin] = weakref.WeakSet()
+            consumers.add(cls)
+
+def _mixin_keys(mixin):
+    return class_helper_meta._current_plan(mixin, mixin.__mro__)[6]
+
+def _tracked_below(cls):
+    """ cls and its subclasses which are tracked mixins """
+    found, stack, seen = [], [cls], set([cls])
+    while stack:
+        klass = stack.pop()
+        if klass in _consumers:
+            found.append(klass)
+        for sub in type.__subclasses__(klass):
+            if sub not in seen:
+                seen.add(sub)
+                stack.append(sub)
+    return found
+
+def _push_mixin_changes(changed):
+    """ Pushes the changed keys of tracked mixins, or of their bases,
+        into the classes including them, and on to whatever includes
+        those.  changed maps classes to keys and gains what is written.
+    """
+    pending = list(changed.items())
+    while pending:
+        cls, keys = pending.pop()
+        for mixin in _tracked_below(cls):
+            for consumer in list(_consumers.get(mixin, ())):
+                written = _refresh_consumer(consumer, keys)
+                if written:
+                    changed.setdefault(consumer, set()).update(written)
+                    pending.append((consumer, written))
+
+def _refresh_consumer(consumer, keys):
+    """ Recopies keys from the consumer's tracked mixins, leaving alone
+        anything the class defines or has overridden itself.
+    """
+    state = consumer.__dict__['__included__']
+    copies, own = state['copies'], consumer.__dict__
+    written = set()
+    for key in keys:
+        current = own.get(key, _missing)
+        if key in copies:
+            if current is not copies[key]:
+                del copies[key]
+                continue
+        elif current is not _missing:
+            continue
+        value = class_helper_meta._lookup_mixins(state['mixins'], key)
+        if value is current:
+            continue
+        if value is _missing:
+            delattr(consumer, key)
+            del copies[key]
+        else:
+            setattr(consumer, key, value)
+            copies[key] = value
+        written.add(key)
+    return written
+
+def propagate(mixin, *names):
+    """ Pushes changes made directly to a mixin, e.g. Mixin.fix = fixed,
+        into every class which included it with track=True.  Without
+        names every attribute is compared.  Patching the mixin through
+        patches() or patch_set propagates automatically.
+    """
+    with _patch_lock:
+        keys = set(names)
+        if not keys:
+            for base in mixin.__mro__:
+                keys.update(base.__dict__)
+            for tracked in _tracked_below(mixin):
+                for consumer in list(_consumers[tracked]):
+                    keys.update(consumer.__dict__['__included__']['copies'])
+        _after_patching([(mixin, key, None) for key in keys])
+
+def _forget_patched(classes):
+    """ Memoized results may depend on whatever a patch replaced """
+    for cls in classes:
+        for cache in _memo_caches(cls).values():
+            cache.clear()
+
+class patch_set(object):
+    """ Patches for many classes, applied all or nothing and reverted
+        in O(changed attributes).
+
+        scoped = patch_set()
+        class Point(patches(Point, into=scoped)):
+            def __abs__(self):
+                return (self.x**2 + self.y**2) ** 0.5
+        scoped.add(Line, {'length': property(line_length)})
+
+        with scoped:
+            abs(Point(3, 4)) # 5.0
+        abs(Point(3, 4)) # TypeError, the patch has been reverted
+    """
+    def __init__(self):
+        self.changes = {}
+        self.undo = None
+
+    def add(self, cls, dct):
+        """ Records changes to cls, later additions win """
+        if self.undo is not None:
+            raise RuntimeError("Cannot add to a patch_set once applied.")
+        self.changes.setdefault(cls, {}).update(dct)
+        return self
+
+    @property
+    def applied(self):
+        return self.undo is not None
+
+    def apply(self):
+        if self.undo is not None:
+            raise RuntimeError("This patch_set has already been applied.")
+        self.undo = _apply_patches(self.changes.items())
+        return self
+
+    def revert(self):
+        if self.undo is None:
+            raise RuntimeError("This patch_set has not been applied.")
+        undo, self.undo = self.undo, None
+        _revert_patches(undo)
+        return self
+
+    def __enter__(self):
+        return self.apply()
+
+    def __exit__(self, *exc_info):
+        self.revert()
+
+def hot_reload(module):
+    """ Re-executes a module's source and patches its live classes with
+        whatever changed, matching classes by name.  Only attributes whose
+        value actually differs are written, functions being compared by
+        their code rather than identity, and each class is patched all or
+        nothing, so a reload costs O(changed attributes).
+
+        Changed functions run with the live module's globals.  Module
+        level names the new source adds are added to the live module,
+        existing ones are left alone.  Returns
+
+        {'patched': {'Point': ['norm']},    # names written per class
+         'stale': {'Point': ['old']},       # gone from the source, kept
+         'skipped': {'Line': 'bases changed'},
+         'added': ['Circle']}
+    """
+    if isinstance(module, str):
+        module = sys.modules[module]
+    spec = getattr(module, '__spec__', None)
+    if spec is not None:
+        import importlib.util
+        fresh = importlib.util.module_from_spec(spec)
+        loader, filename = spec.loader, spec.origin
+    else:
+        # Python 2, which has no module specs
+        import pkgutil
+        fresh = types.ModuleType(module.__name__)
+        loader = pkgutil.get_loader(module)
+        filename = fresh.__file__ = loader.get_filename(module.__name__)
+    # Compiled from the source itself, a cached .pyc may predate the edit
+    source = loader.get_source(module.__name__)
+    if source is None:
+        if spec is None:
+            raise ImportError("No source to reload %s from" % module.__name__)
+        loader.exec_module(fresh)
+    else:
+        exec(compile(source, filename, 'exec'), fresh.__dict__)
+
+    live_globals = module.__dict__
+    report = {'patched': {}, 'stale': {}, 'skipped': {}, 'added': []}
+    for name, new in fresh.__dict__.items():
+        if name not in live_globals:
+            setattr(module, name, new)
+            report['added'].append(name)
+            continue
+        live = live_globals[name]
+        if not (isinstance(new, type) and isinstance(live, type)):
+            continue
+        if new.__module__ != module.__name__ or live.__name__ != new.__name__:
+            continue
+        if live is new:
+            continue
+        reason = _reload_conflict(live, new)
+        if reason is not None:
+            report['skipped'][name] = reason
+            continue
+        changes, stale = _class_changes(live, new, live_globals)
+        if changes:
+            _apply_patches([(live, changes)])
+            report['patched'][name] = sorted(changes)
+        if stale:
+            report['stale'][name] = sorted(stale)
+    return report
+
+def _reload_conflict(live, new):
+    """ Why new cannot be patched into live, or None """
+    names = lambda cls: [base.__name__ for base in cls.__bases__]
+    if names(live) != names(new):
+        return 'bases changed'
+    if live.__dict__.get('__slots__') != new.__dict__.get('__slots__'):
+        return '__slots__ changed'
+    if type(live).__name__ != type(new).__name__:
+        return 'metaclass changed'
+    return None
+
+_layout_descriptors = (types.MemberDescriptorType, types.GetSetDescriptorType)
+
+def _class_changes(live, new, live_globals):
+    """ ({key: value to patch into live}, keys only live still has) """
+    old = live.__dict__
+    changes = {}
+    for key, value in new.__dict__.items():
+        if key in _unflattened or key.startswith('_abc_'):
+            continue
+        if isinstance(value, _layout_descriptors):
+            # Slot descriptors only apply to the class which made them,
+            # and _reload_conflict has checked the slots are the same
+            continue
+        if isinstance(value, type) and isinstance(old.get(key), type):
+            # Nested classes keep their identity, reload them separately
+            continue
+        previous = old.get(key, _missing)
+        if previous is not _missing and _same_value(previous, value):
+            continue
+        changes[key] = _rebind_value(value, live, new, live_globals)
+    stale = [key for key in old if key not in new.__dict__
+             and key not in _unflattened and not key.startswith('_abc_')]
+    return changes, stale
+
+def _same_value(old, new, seen=None):
+    if type(old) is not type(new):
+        return False
+    if isinstance(new, types.FunctionType):
+        return (_same_code(old.__code__, new.__code__)
+                and old.__defaults__ == new.__defaults__
+                and getattr(old, '__kwdefaults__', None) == getattr(new, '__kwdefaults__', None)
+                and _same_closure(old.__closure__, new.__closure__, seen))
+    if isinstance(new, (staticmethod, classmethod)):
+        return _same_value(old.__func__, new.__func__, seen)
+    if isinstance(new, property):
+        return all(_same_value(getattr(old, key), getattr(new, key), seen)
+                   for key in ('fget', 'fset', 'fdel'))
+    if isinstance(new, type):
+        # e.g. the __class__ cell of methods using super(), classes
+        # match by name as they do in hot_reload
+        return old.__name__ == new.__name__ and old.__module__ == new.__module__
+    try:
+        return bool(old == new)
+    except Exception:
+        return False
+
+def _same_closure(old, new, seen):
+    """ Whether the cells hold the same values, e.g. the function a
+        decorator wrapped.  Cells met again, as in recursive closures,
+        count as the same.
+    """
+    if old is None or new is None:
+        return old is new
+    if len(old) != len(new):
+        return False
+    seen = set() if seen is None else seen
+    for a, b in zip(old, new):
+        if (id(a), id(b)) in seen:
+            continue
+        seen.add((id(a), id(b)))
+        try:
+            a, b = a.cell_contents, b.cell_contents
+        except ValueError:
+            # Empty cells
+            if _cell_is_empty(a) != _cell_is_empty(b):
+                return False
+            continue
+        if a is not b and not _same_value(a, b, seen):
+            return False
+    return True
+
+def _cell_is_empty(cell):
+    try:
+        cell.cell_contents
+    except ValueError:
+        return True
+    return False
+
+def _same_code(old, new):
+    """ Equal code, ignoring line numbers so moved code is unchanged """
+    if old.co_code != new.co_code or old.co_names != new.co_names:
+        return False
+    for key in ('co_varnames', 'co_freevars', 'co_cellvars', 'co_argcount',
+                'co_kwonlyargcount', 'co_flags'):
+        # co_kwonlyargcount is missing on Python 2
+        if getattr(old, key, None) != getattr(new, key, None):
+            return False
+    if len(old.co_consts) != len(new.co_consts):
+        return False
+    for a, b in zip(old.co_consts, new.co_consts):
+        if isinstance(a, types.CodeType) and isinstance(b, types.CodeType):
+            if not _same_code(a, b):
+                return False
+        elif type(a) is not type(b) or a != b:
+            return False
+    return True
+
+try:
+    _cell = types.CellType
+except AttributeError:
+    # Before Python 3.8
+    def _cell(value):
+        return (lambda: value).__closure__[0]
+
+def _rebind_value(value, live, new, live_globals):
+    """ value from the re-executed module, made to run against the live
+        module: live globals, and __class__ (for super()) set to live.
+    """
+    if isinstance(value, types.FunctionType):
+        closure = value.__closure__
+        if closure is not None:
+            closure = tuple(_cell(live) if name == '__class__'
+                            and cell.cell_contents is new else cell
+                            for name, cell in zip(value.__code__.co_freevars, closure))
+        func = types.FunctionType(value.__code__, live_globals, value.__name__,
+                                  value.__defaults__, closure)
+        func.__dict__.update(value.__dict__)
+        func.__doc__ = value.__doc__
+        func.__module__ = value.__module__
+        # Python 3 only
+        for key in ('__kwdefaults__', '__qualname__', '__annotations__'):
+            if hasattr(value, key):
+                setattr(func, key, getattr(value, key))
+        return func
+    if isinstance(value, (staticmethod, classmethod)):
+        return type(value)(_rebind_value(value.__func__, live, new, live_globals))
+    if isinstance(value, property):
+        funcs = [getattr(value, key) for key in ('fget', 'fset', 'fdel')]
+        funcs = [func and _rebind_value(func, live, new, live_globals) for func in funcs]
+        return property(funcs[0], funcs[1], funcs[2], value.__doc__)
+    return value
+
+def _slot_names(cls):
+    """ The names of the slot descriptors cls itself defines, mangled
+        the way they appear in its __dict__.
+    """
+    slots = cls.__dict__.get('__slots__', ())
+    if isinstance(slots, str):
+        slots = (slots,)
+    names = []
+    for name in slots:
+        if name.startswith('__') and not name.endswith('__'):
+            name = '_%s%s' % (cls.__name__.lstrip('_'), name)
+        names.append(name)
+    return tuple(names)
+
+def _merge_slots(params, extra):
+    """ Combines the slots from the class body, included mixins and
+        extra names, dropping duplicates and anything a base already
+        provides for its instances.
+    """
+    dct, bases = params['dct'], params.get('bases', ())
+    body = dct.get('__slots__', ())
+    if isinstance(body, str):
+        body = (body,)
+    provided = set()
+    for base in bases:
+        if base.__dictoffset__:
+            provided.add('__dict__')
+        if base.__weakrefoffset__:
+            provided.add('__weakref__')
+        for cls in base.__mro__:
+            provided.update(_slot_names(cls))
+    merged = []
+    for name in tuple(body) + tuple(params.get('included_slots', ())) + tuple(extra):
+        if name not in provided:
+            provided.add(name)
+            merged.append(name)
+    return tuple(merged)
+
+# Compiled record() methods, keyed on the tuple of field names
+_record_codes = {}
+
+try:
+    _is_identifier = str.isidentifier
+except AttributeError:  # Python 2
+    import re
+    _is_identifier = re.compile(r'[A-Za-z_]\w*\Z').match
+
+def _record_code(fields):
+    """ Compiles the methods record() generates for fields, once """
+    code = _record_codes.get(fields)
+    if code is not None:
+        return code
+    seen = set()
+    for field in fields:
+        if not isinstance(field, str) or not _is_identifier(field):
+            raise TypeError("Record fields must be identifiers, not %r" % (field,))
+        # self would clash with the generated methods' own argument
+        if (keyword.iskeyword(field) or field.startswith('__') or field == 'self'
+                or field in seen):
+            raise TypeError("Invalid record field %r" % (field,))
+        seen.add(field)
+    values = ''.join('self.%s, ' % field for field in fields)
+    others = ''.join('other.%s, ' % field for field in fields)
+    template = '%%s(%s)' % ', '.join('%s=%%r' % field for field in fields)
+    source = '\n'.join([
+        'def __init__(self%s):' % ''.join(', %s' % field for field in fields),
+        ''.join('    self.%s = %s\n' % (field, field) for field in fields) + '    pass',
+        'def __eq__(self, other):',
+        '    if other.__class__ is self.__class__:',
+        '        return (%s) == (%s)' % (values, others),
+        '    return NotImplemented',
+        'def __ne__(self, other):',
+        '    if other.__class__ is self.__class__:',
+        '        return (%s) != (%s)' % (values, others),
+        '    return NotImplemented',
+        'def __hash__(self):',
+        '    return hash((%s))' % values,
+        'def __repr__(self):',
+        '    return %r %% (self.__class__.__name__, %s)' % (template, values),
+        'def __len__(self):',
+        '    return %d' % len(fields),
+        'def __iter__(self):',
+        '    return iter((%s))' % values,
+        'def __getitem__(self, index):',
+        '    return (%s)[index]' % values,
+        ''])
+    code = compile(source, '<record %s>' % ', '.join(fields), 'exec')
+    return _record_codes.setdefault(fields, code)
+
+def _prepare_record(params, fields):
+    """ Adds the generated methods to the class body, and the fields to
+        its __slots__ unless an existing class is being patched.  Values
+        the body gives the fields become their defaults.
+    """
+    dct = params['dct']
+    defaults = {}
+    for field in fields:
+        if field in dct:
+            defaults[field] = dct.pop(field)
+    namespace = {}
+    exec(_record_code(fields), namespace)
+    init = namespace['__init__']
+    if defaults:
+        required = len(fields) - len(defaults)
+        if any(field in defaults for field in fields[:required]):
+            raise TypeError("Fields without defaults must come first")
+        init.__defaults__ = tuple(defaults[field] for field in fields[required:])
+    # A hand written __eq__ must not be paired with a generated __hash__
+    if '__eq__' in dct:
+        for key in ('__ne__', '__hash__'):
+            namespace.pop(key)
+    qualname = dct.get('__qualname__', params['name'])
+    for key, func in namespace.items():
+        if key in dct or key == '__builtins__':
+            continue
+        func.__qualname__ = '%s.%s' % (qualname, key)
+        func.__module__ = dct.get('__module__', func.__module__)
+        dct[key] = func
+    dct.setdefault('_fields', fields)
+    if 'cls' not in params:
+        dct['__slots__'] = _merge_slots(params, fields)
+
+def _is_special(key):
+    return key[:2] == '__' and key[-2:] == '__'
+
+def _lazy_getattr(mixins, pending, fallback):
+    """ Builds the __getattr__ installed by includes(..., lazy=True).
+        fallback is the __getattr__ the class would otherwise have had.
+    """
+    state = {'mixins': mixins, 'pending': pending,
+             'fallback': fallback, 'owner': None}
+
+    def __getattr__(self, key):
+        owner = state['owner']
+        if key in pending and key not in owner.__dict__:
+            value = class_helper_meta._lookup_mixins(mixins, key)
+            if value is not _missing:
+                setattr(owner, key, value)
+                return getattr(self, key)
+        if fallback is not None:
+            return fallback.__get__(self, type(self))(key)
+        for base in owner.__mro__[1:]:
+            inherited = base.__dict__.get('__getattr__')
+            if inherited is not None:
+                return inherited.__get__(self, type(self))(key)
+        msg = "%r object has no attribute %r"
+        raise AttributeError(msg % (type(self).__name__, key))
+
+    __getattr__.lazy_includes = state
+    return __getattr__
+
+def materialize(cls):
+    """ Copies every attribute still pending from includes(..., lazy=True)
+        into the classes which included them, e.g. before relying on
+        class level access such as cls.some_mixin_method.
+    """
+    for base in cls.__mro__:
+        hook = base.__dict__.get('__getattr__')
+        state = getattr(hook, 'lazy_includes', None)
+        while state is not None:
+            owner = state['owner']
+            for key in state['pending']:
+                if key not in owner.__dict__:
+                    value = class_helper_meta._lookup_mixins(state['mixins'], key)
+                    setattr(owner, key, value)
+            state = getattr(state['fallback'], 'lazy_includes', None)
+
+# Inherited attributes which describe a single class and are never flattened
+_unflattened = _class_slots | frozenset(('__slots__',
+    '__abstractmethods__', '__module__', '__doc__', '__qualname__',
+    '__orig_bases__', '__parameters__', '__firstlineno__',
+    '__static_attributes__'))
+
+# Set once flatten() is first used, so patching only searches for
+# flattened subclasses when there can be some
+_flattening = False
+
+def _flatten(cls, names):
+    """ Copies what cls resolves from its bases into cls itself, unless
+        cls already defines it, recording the copies in cls.__flattened__.
+    """
+    resolved = {}
+    for base in reversed(cls.__mro__[1:]):
+        if base is not object:
+            resolved.update(base.__dict__)
+    own = cls.__dict__
+    copies = {}
+    for key in (names or resolved):
+        if key in own or key not in resolved or key in _unflattened:
+            continue
+        if key.startswith('_abc_'):
+            continue
+        copies[key] = resolved[key]
+    with _patch_lock:
+        for key, value in copies.items():
+            setattr(cls, key, value)
+        setattr(cls, '__flattened__', {'names': names, 'copies': copies})
+
+def reflatten(*classes):
+    """ Brings classes built with flatten() up to date after one of their
+        bases changed.  Copies since replaced on the class itself are
+        left alone.  Patching a base through patches() or patch_set
+        reflattens its subclasses automatically.
+    """
+    with _patch_lock:
+        for cls in classes:
+            state = cls.__dict__.get('__flattened__')
+            if state is None:
+                raise TypeError("%s was not built with flatten()" % cls.__name__)
+            # Lookups fall back to the bases while the copies are gone
+            own = cls.__dict__
+            for key, value in state['copies'].items():
+                if own.get(key, _missing) is value:
+                    delattr(cls, key)
+            _flatten(cls, state['names'])
+
+def _reflatten_subclasses(classes):
+    """ Reflattens every flattened subclass of classes, bases first """
+    found, stack = set(), list(classes)
+    while stack:
+        for sub in type.__subclasses__(stack.pop()):
+            if sub not in found:
+                found.add(sub)
+                stack.append(sub)
+    flattened = [cls for cls in found if '__flattened__' in cls.__dict__]
+    flattened.sort(key=lambda cls: len(cls.__mro__))
+    reflatten(*flattened)
+
+# Set once memoize() is first used, so patching only clears memoized
+# results when there can be some
+_memoizing = False
+
+try:
+    _move_to_end = OrderedDict.move_to_end
+except AttributeError:  # Python 2
+    def _move_to_end(ordered, key):
+        ordered[key] = ordered.pop(key)
+
+class _memo_cache(object):
+    """ Results of one memoized method or property, keyed on the identity
+        of the instance and the arguments.  Holds at most maxsize entries,
+        dropping the least recently used, and entries expire ttl seconds
+        after they were computed.  An instance's entries are dropped as
+        soon as the instance dies, so the cache never keeps one alive.
+        Instances which cannot be weakly referenced, e.g. tuples, are
+        held by their entries instead, until maxsize evicts them.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # {id(instance): (weak reference or the instance, keys of its entries)}
+        self.owners = {}
+        # Reentrant, since an instance may die and call _forget while
+        # the cache is being updated
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, stored = entry
+                if self.ttl is None or default_timer() - stored < self.ttl:
+                    _move_to_end(self.entries, key)
+                    self.hits += 1
+                    return value
+                self._discard(key)
+            self.misses += 1
+            return _missing
+
+    def put(self, instance, key, value):
+        with self.lock:
+            owner = self.owners.get(key[0])
+            if owner is None:
+                try:
+                    ref = weakref.ref(instance, partial(self._forget, key[0]))
+                except TypeError:
+                    # Holding the instance keeps its id from being reused
+                    ref = instance
+                owner = self.owners[key[0]] = (ref, set())
+            owner[1].add(key)
+            self.entries[key] = (value, default_timer())
+            _move_to_end(self.entries, key)
+            if self.maxsize is not None:
+                while len(self.entries) > self.maxsize:
+                    self._discard(next(iter(self.entries)))
+
+    def _discard(self, key):
+        self.entries.pop(key, None)
+        owner = self.owners.get(key[0])
+        if owner is not None:
+            owner[1].discard(key)
+            if not owner[1]:
+                del self.owners[key[0]]
+
+    def _forget(self, ident, ref=None):
+        with self.lock:
+            owner = self.owners.pop(ident, None)
+            if owner is not None:
+                for key in owner[1]:
+                    self.entries.pop(key, None)
+
+    def clear(self, instance=_missing):
+        with self.lock:
+            if instance is _missing:
+                self.entries.clear()
+                self.owners.clear()
+            else:
+                self._forget(id(instance))
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries), 'maxsize': self.maxsize,
+                    'ttl': self.ttl}
+
+def _memoized(value, cache):
+    """ Wraps a function or property so results come from cache.  The
+        cache is reachable as memo_cache on the wrapping function.
+    """
+    if isinstance(value, property):
+        fset, fdel = value.fset, value.fdel
+        if fset is not None:
+            def fset(self, new, fset=fset):
+                fset(self, new)
+                cache.clear(self)
+        if fdel is not None:
+            def fdel(self, fdel=fdel):
+                fdel(self)
+                cache.clear(self)
+        fget = _memoized(value.fget, cache)
+        return property(fget, fset, fdel, value.__doc__)
+    if not callable(value) or isinstance(value, (type, staticmethod, classmethod)):
+        raise TypeError("Can only memoize methods and properties, not %r" % (value,))
+
+    @wraps(value)
+    def memoized(self, *args, **kwargs):
+        key = (id(self), args, frozenset(kwargs.items())) if kwargs else (id(self), args)
+        result = cache.get(key)
+        if result is _missing:
+            result = value(self, *args, **kwargs)
+            cache.put(self, key, result)
+        return result
+    memoized.memo_cache = cache
+    return memoized
+
+def _weakref_slot(params):
+    """ Adds a __weakref__ slot to a class with __slots__, unless a base
+        already provides one, so memoized results can follow instances.
+    """
+    dct = params['dct']
+    slots = dct.get('__slots__')
+    if slots is None or 'cls' in params:
+        return
+    if isinstance(slots, str):
+        slots = (slots,)
+    if '__weakref__' in slots:
+        return
+    for base in params.get('bases', ()):
+        # Variable size instances, e.g. tuples, cannot have one
+        if base.__weakrefoffset__ or base.__itemsize__:
+            return
+    dct['__slots__'] = tuple(slots) + ('__weakref__',)
+
+def _inherited_attribute(params, name):
+    """ The value name resolves to in the bases of the class being built,
+        or in the class being patched.
+    """
+    if 'cls' in params:
+        search = params['cls'].__mro__
+    else:
+        search = [cls for base in params.get('bases', ()) for cls in base.__mro__]
+    for cls in search:
+        if name in cls.__dict__:
+            return cls.__dict__[name]
+    raise TypeError("Cannot memoize %s, the class does not define it" % name)
+
+def _memo_caches(cls):
+    """ {name: _memo_cache} for every memoized attribute cls resolves """
+    caches = {}
+    for base in reversed(cls.__mro__):
+        for key, value in base.__dict__.items():
+            if isinstance(value, property):
+                value = value.fget
+            cache = getattr(value, 'memo_cache', None)
+            if isinstance(cache, _memo_cache):
+                caches[key] = cache
+            else:
+                caches.pop(key, None)
+    return caches
+
+def cache_info(cls):
+    """ Hit and miss counts, size and bounds for each memoized attribute
+        of cls, as {name: {'hits', 'misses', 'size', 'maxsize', 'ttl'}}.
+    """
+    return dict((key, cache.info()) for key, cache in _memo_caches(cls).items())
+
+def invalidate(cls_or_instance, *names):
+    """ Forgets memoized results, of every instance when given a class,
+        or of one instance.  Only the named attributes, if any are given.
+    """
+    if isinstance(cls_or_instance, type):
+        cls, instance = cls_or_instance, _missing
+    else:
+        cls, instance = type(cls_or_instance), cls_or_instance
+    caches = _memo_caches(cls)
+    for key in (names or caches):
+        if key not in caches:
+            raise AttributeError("%s has no memoized attribute %s" % (cls.__name__, key))
+        caches[key].clear(instance)
+
+class _columns(object):
+    """ Base class of the containers made by columnar() """
+    __slots__ = ('_columns',)
+
+    def __init__(self, rows=()):
+        self._columns = [self._new_column(field) for field in self.fields]
+        self.extend(rows)
+
+    @classmethod
+    def _new_column(cls, field, values=()):
+        typecode = cls.typecodes.get(field)
+        if typecode is None:
+            return list(values)
+        return array.array(typecode, values)
+
+    @classmethod
+    def _from_columns(cls, columns):
+        table = cls.__new__(cls)
+        table._columns = columns
+        return table
+
+    def append(self, row):
+        size = len(self)
+        try:
+            for column, get in zip(self._columns, self._getters):
+                column.append(get(row))
+        except BaseException:
+            self._truncate(size)
+            raise
+
+    def extend(self, rows):
+        if not isinstance(rows, (list, tuple)):
+            rows = list(rows)
+        size = len(self)
+        try:
+            for column, get in zip(self._columns, self._getters):
+                column.extend(map(get, rows))
+        except BaseException:
+            self._truncate(size)
+            raise
+
+    def _truncate(self, size):
+        """ Undoes a failed append or extend, so no column is left
+            longer than the others.
+        """
+        for column in self._columns:
+            del column[size:]
+
+    def column(self, field, numpy=False):
+        """ The values of one field, as a NumPy array sharing the column's
+            memory when numpy=True and the column has a typecode.
+        """
+        column = self._columns[self.fields.index(field)]
+        if numpy:
+            import numpy as np
+            if isinstance(column, array.array):
+                return np.frombuffer(column, dtype=column.typecode)
+            return np.array(column, dtype=object)
+        return column
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._from_columns([column[index] for column in self._columns])
+        return self.record(*[column[index] for column in self._columns])
+
+    def __iter__(self):
+        return iter(map(self.record, *self._columns))
+
+    def __repr__(self):
+        return '%s(%d rows)' % (type(self).__name__, len(self))
+
+def columnar(record, typecodes=None, fields=None):
+    """ Makes a struct-of-arrays container for instances of record.  Each
+        field is stored in its own column, an array.array for fields
+        given an array typecode and a list otherwise.
+
+        Points = columnar(Point, {'x': 'd', 'y': 'd'})
+        table = Points(points)
+        table.append(Point(1.0, 2.0))
+        sum(table.x)               # a whole column at once
+        table.column('x', numpy=True).mean()
+        table[0].norm()            # rows are rebuilt as Point instances
+        table[10:20]               # a Points of those rows
+
+        Fields default to record._fields, as on namedtuples.  Rows are
+        rebuilt with record(*values), so patches and includes made to
+        record show up on them.
+    """
+    if fields is None:
+        fields = getattr(record, '_fields', None)
+        if fields is None:
+            raise TypeError("%s has no _fields, fields must be given" % record.__name__)
+    fields = tuple(fields)
+    typecodes = dict(typecodes or {})
+    unknown = set(typecodes).difference(fields)
+    if unknown:
+        raise TypeError("Typecodes given for unknown fields %s" % sorted(unknown))
+    if not fields:
+        raise TypeError("A columnar container needs at least one field")
+    for field in fields:
+        if hasattr(_columns, field) or field in ('record', 'fields', 'typecodes'):
+            raise TypeError("Field %s clashes with a container attribute" % field)
+    dct = {'__slots__': (), 'record': record, 'fields': fields,
+           'typecodes': typecodes,
+           '_getters': tuple(attrgetter(field) for field in fields)}
+    for index, field in enumerate(fields):
+        column = itemgetter(index)
+        dct[field] = property(lambda self, column=column: column(self._columns),
+                              doc="The %s column" % field)
+    return type('%sColumns' % record.__name__, (_columns,), dct)
+
+class _portable_meta(class_helper_meta):
+    """ The metaclass of portable() surrogates.  Records how the class
+        was built, so another process can build it again.
+    """
+    def __new__(mcls, name, surrogates_or_bases, dct):
+        spec = _portable_spec(name, surrogates_or_bases, dct)
+        ref = _portable_ref(_portable_digest(spec), spec)
+        cls = class_helper_meta.__new__(mcls, name, surrogates_or_bases, dct)
+        # Looked up in the class's own __dict__, subclasses need their own
+        type.__setattr__(cls, '__portable__', ref)
+        _portable_classes[ref.digest] = cls
+        return cls
+
+# Every portable class by its digest.  Of classes built from the same
+# spec, the newest is used, older ones may only be awaiting collection.
+_portable_classes = weakref.WeakValueDictionary()
+
+# Classes built from a spec received from another process.  They are
+# kept, since more instances usually follow.
+_rebuilt_classes = {}
+_rebuilt_lock = threading.RLock()
+
+class _portable_ref(object):
+    """ Pickles as the constructor of a portable class's instances.
+        Pickle memoizes it like any object, so however many instances
+        one pickle holds, the spec is written and read only once.
+    """
+    __slots__ = ('digest', 'spec')
+
+    def __init__(self, digest, spec):
+        self.digest = digest
+        self.spec = spec
+
+    def __reduce__(self):
+        return (_portable_constructor, (self.digest, self.spec))
+
+    # Pickle insists on reducing instances to a callable
+    def __call__(self, *args):
+        return _portable_constructor(self.digest, self.spec)(*args)
+
+def _portable_spec(name, surrogates_or_bases, dct):
+    """ (name, parts, namespace), where each part is a helper, another
+        portable class or a plain base class.
+    """
+    namespace = dict(dct)
+    if '__classcell__' in namespace:
+        raise TypeError("Portable class %s cannot use super() without "
+                        "arguments" % name)
+    return (name, tuple(map(_portable_part, surrogates_or_bases)), namespace)
+
+def _portable_part(item):
+    if isinstance(item, class_helper_meta):
+        if item.name == 'patches':
+            raise TypeError("Cannot combine portable with patches")
+        extra = [(key, value) for key, value in item.__dict__.items()
+                 if not key.startswith('_')]
+        return ('helper', type(item), item.name, item.solo,
+                tuple(map(_portable_part, item.args)), tuple(sorted(extra)))
+    if isinstance(item, type):
+        ref = item.__dict__.get('__portable__')
+        if ref is not None:
+            return ('class', ref.digest, ref.spec)
+    return ('value', item)
+
+def _portable_digest(spec):
+    # Imported here, only portable() needs them
+    import hashlib
+    import pickle
+    try:
+        data = pickle.dumps(spec, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        msg = "Portable class %s must be built from picklable parts: %s"
+        raise TypeError(msg % (spec[0], e))
+    return hashlib.sha1(data).hexdigest()
+
+def _portable_reduce(self, protocol):
+    try:
+        from copyreg import __newobj__
+    except ImportError:  # Python 2
+        from copy_reg import __newobj__
+    reduced = object.__reduce_ex__(self, max(protocol, 2))
+    ref = type(self).__dict__.get('__portable__')
+    if ref is None or reduced[0] is not __newobj__:
+        # A subclass which is not portable itself, or one which
+        # reduces its instances its own way
+        return reduced
+    # (copyreg.__newobj__, (cls,) + args, state, ...) made by the ref
+    return (ref, reduced[1][1:]) + reduced[2:]
+
+def _portable_constructor(digest, spec):
+    cls = _portable_class(digest, spec)
+    return partial(cls.__new__, cls)
+
+def _portable_class(digest, spec):
+    """ The class built from spec in this process, building it first if
+        need be.
+    """
+    cls = _portable_classes.get(digest)
+    if cls is None:
+        # Reentrant, since portable bases are rebuilt first
+        with _rebuilt_lock:
+            cls = _portable_classes.get(digest)
+            if cls is None:
+                name, parts, namespace = spec
+                bases = tuple(map(_rebuilt_part, parts))
+                cls = type(name, bases, dict(namespace))
+                _rebuilt_classes[digest] = cls
+                _portable_classes[digest] = cls
+    return cls
+
+def _rebuilt_part(part):
+    kind = part[0]
+    if kind == 'helper':
+        mcls, name, solo, args, extra = part[1:]
+        args = tuple(map(_rebuilt_part, args))
+        return mcls._wrap(name, args, solo=solo, **dict(extra))
+    if kind == 'class':
+        return _portable_class(part[1], part[2])
+    return part[1]
+
+class _deferred_meta(_portable_meta):
+    """ The metaclass of lazy() surrogates.  Being the most derived
+        metaclass in the bases, it gets the class statement and only
+        records it, without running any other helper.
+    """
+    def __new__(mcls, name, surrogates_or_bases, dct):
+        rest = tuple(item for item in surrogates_or_bases
+                     if not isinstance(item, _deferred_meta))
+        if not _mro_entries:
+            return type(name, rest, dct)
+        return _deferred_class(name, rest, dct)
+
+# Placeholders can only be subclassed through __mro_entries__, new in
+# Python 3.7.  Before it lazy() builds the class at once.
+_mro_entries = sys.version_info >= (3, 7)
+
+# Every _deferred_class not built yet
+_deferred = weakref.WeakSet()
+_deferred_lock = threading.RLock()
+
+class _deferred_class(object):
+    # Stands in for a class from lazy() until it is first really used.
+    # No docstring, __doc__ must come from the real class.
+    __slots__ = ('_spec', '_cls', '__weakref__')
+
+    def __init__(self, name, bases, dct):
+        _setter(self, '_spec', (name, bases, dct))
+        _setter(self, '_cls', None)
+        _deferred.add(self)
+
+    def _resolve(self):
+        cls = self._cls
+        if cls is None:
+            with _deferred_lock:
+                cls = self._cls
+                if cls is None:
+                    name, bases, dct = self._spec
+                    # type() hands over to the most derived metaclass
+                    cls = type(name, bases, dct)
+                    _setter(self, '_cls', cls)
+                    _setter(self, '_spec', None)
+                    _deferred.discard(self)
+                    _rebind(self, cls)
+        return cls
+
+    def _describe(self, key):
+        cls = self._cls
+        if cls is not None:
+            return getattr(cls, key)
+        name, bases, dct = self._spec
+        return dct.get(key, name)
+
+    __name__ = property(lambda self: self._describe('__name__'))
+    __module__ = property(lambda self: self._describe('__module__'))
+    __doc__ = property(lambda self: self._resolve().__doc__)
+
+    def __getattr__(self, key):
+        return getattr(self._resolve(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self._resolve(), key, value)
+
+    def __delattr__(self, key):
+        delattr(self._resolve(), key)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._resolve())
+
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self._resolve())
+
+    def __mro_entries__(self, bases):
+        return (self._resolve(),)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __repr__(self):
+        if self._cls is not None:
+            return repr(self._cls)
+        return '<lazy class %s.%s>' % (self._describe('__module__'),
+                                       self._describe('__qualname__'))
+
+def _rebind(proxy, cls):
+    """ Points the module level name of a forced class at the class
+        itself, so pickling and identity checks see the real thing.
+    """
+    module = sys.modules.get(cls.__module__)
+    name = getattr(cls, '__qualname__', cls.__name__)
+    if module is not None and '.' not in name:
+        if getattr(module, name, None) is proxy:
+            setattr(module, name, cls)
+
+def force(cls):
+    """ The class behind a lazy() placeholder, building it if need be.
+        Anything else is returned unchanged.
+    """
+    if isinstance(cls, _deferred_class):
+        return cls._resolve()
+    return cls
+
+def force_all():
+    """ Builds every lazy() class not built yet, e.g. before forking
+        workers, and returns how many were built.
+    """
+    count = 0
+    while True:
+        pending = list(_deferred)
+        if not pending:
+            return count
+        for proxy in pending:
+            proxy._resolve()
+            count += 1
+
+# Constants which class_cache keys on their value, everything else is
+# keyed on its identity
+_by_value = frozenset((str, bytes, int, float, complex, bool, type(None)))
+
+# Helpers with side effects, or whose result is not a plain class
+_uncacheable = frozenset(('patches', 'lazy'))
+
+def _token(value):
+    if type(value) in _by_value:
+        return (type(value), value)
+    if isinstance(value, tuple):
+        return (tuple, tuple(map(_token, value)))
+    return id(value)
+
+def _structural_key(name, bases, dct, keep):
+    """ A key equal for class specs which would build the same class,
+        or None when the spec must not be cached.  Objects keyed on their
+        identity are appended to keep, which must outlive the key.
+    """
+    parts = []
+    for item in bases:
+        if isinstance(item, class_helper_meta):
+            if item.name in _uncacheable:
+                return None
+            args = item.args
+            if item.name == 'py6':
+                inner = _structural_key(None, args, {}, keep)
+                if inner is None:
+                    return None
+                parts.append(inner)
+                continue
+            extra = [(key, value) for key, value in item.__dict__.items()
+                     if not key.startswith('_')]
+            parts.append((item._shape, tuple(map(_token, args)), _token(tuple(sorted(extra)))))
+            keep.extend(args)
+        else:
+            parts.append(id(item))
+            keep.append(item)
+    items = tuple(sorted((key, _token(value)) for key, value in dct.items()))
+    keep.extend(dct.values())
+    return (name, tuple(parts), items)
+
+class class_cache(object):
+    """ Returns the same class for every identical class spec, instead of
+        building a new one each time.  Specs match when the name, the
+        bases and helpers, and the namespace are the same: strings and
+        numbers compare by value, everything else by identity.
+
+        cache = class_cache(maxsize=256)
+        Handler = cache.build('Handler', (includes(A), metaclass(M)), {})
+        cache.build('Handler', (includes(A), metaclass(M)), {}) is Handler
+
+        The maxsize most recently used classes are kept alive, older ones
+        are found for as long as something else keeps them alive.  Specs
+        using patches or lazy are always built afresh.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.recent = OrderedDict()
+        self.index = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+    def build(self, name, bases, dct):
+        keep = []
+        key = _structural_key(name, tuple(bases), dct, keep)
+        if key is None:
+            with self.lock:
+                self.uncached += 1
+            return type(name, tuple(bases), dict(dct))
+        with self.lock:
+            cls = self._lookup(key)
+            if cls is not None:
+                self.hits += 1
+                return cls
+            self.misses += 1
+        # The helpers write into the namespace, so give them a copy
+        cls = type(name, tuple(bases), dict(dct))
+        with self.lock:
+            # Another thread may have built the same spec meanwhile
+            winner = self._lookup(key)
+            if winner is None:
+                winner = self._store(key, cls, keep)
+            return winner
+
+    def _lookup(self, key):
+        cls = self.recent.get(key)
+        if cls is not None:
+            _move_to_end(self.recent, key)
+            return cls
+        entry = self.index.get(key)
+        if entry is not None:
+            cls = entry[0]()
+            if cls is not None:
+                self._remember(key, cls)
+        return cls
+
+    def _store(self, key, cls, keep):
+        index = self.index
+        def evict(ref, key=key):
+            entry = index.get(key)
+            if entry is not None and entry[0] is ref:
+                del index[key]
+        index[key] = (weakref.ref(cls, evict), tuple(keep))
+        self._remember(key, cls)
+        return cls
+
+    def _remember(self, key, cls):
+        recent = self.recent
+        recent[key] = cls
+        _move_to_end(recent, key)
+        if self.maxsize is not None:
+            while len(recent) > self.maxsize:
+                recent.popitem(last=False)
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'uncached': self.uncached, 'recent': len(self.recent),
+                    'alive': len(self.index), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self.lock:
+            self.recent.clear()
+            self.index.clear()
+
+# The default class_cache used by cached_class
+_class_cache = class_cache()
+
+def cached_class(name, bases, dct):
+    """ type(name, bases, dct) through a shared class_cache, so request
+        paths generating the same class over and over build it once.
+    """
+    return _class_cache.build(name, bases, dct)
+
+# The active _instrumentation, or None while instrumentation is disabled
+_monitor = None
+
+# Construction hooks, only called while instrumentation is enabled.
+# The tuples are replaced rather than mutated, so constructions running
+# on other threads can iterate them without a lock.
+_hooks = {'pre': (), 'post': ()}
+_hooks_lock = threading.Lock()
+
+def _timing():
+    return {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+
+def _add_timing(timing, elapsed):
+    timing['calls'] += 1
+    timing['seconds'] += elapsed
+    if elapsed > timing['max_seconds']:
+        timing['max_seconds'] = elapsed
+
+class _instrumentation(object):
+    """ Statistics gathered by class_helper_meta while enabled """
+    def __init__(self):
+        self.classes = _timing()
+        self.helpers = {}
+        self.counters = {'includes_attributes': 0, 'patches_setattrs': 0}
+        self.lock = threading.Lock()
+
+    def before(self, name, surrogates_or_bases, dct):
+        for hook in _hooks['pre']:
+            hook(name, surrogates_or_bases, dct)
+        return default_timer()
+
+    def after(self, cls, start):
+        elapsed = default_timer() - start
+        with self.lock:
+            _add_timing(self.classes, elapsed)
+        for hook in _hooks['post']:
+            hook(cls, elapsed)
+
+    def record(self, func, start):
+        elapsed = default_timer() - start
+        self.add(func.__name__[len('_unwrap_'):], elapsed)
+        return elapsed
+
+    def add(self, name, elapsed):
+        with self.lock:
+            timing = self.helpers.get(name)
+            if timing is None:
+                timing = self.helpers[name] = _timing()
+            _add_timing(timing, elapsed)
+
+    def count(self, counter, amount):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def snapshot(self):
+        with self.lock:
+            stats = {'classes': dict(self.classes)}
+            stats['helpers'] = dict((name, dict(timing))
+                                    for name, timing in self.helpers.items())
+            stats.update(self.counters)
+        return stats
+
+def enable_instrumentation():
+    """ Starts gathering statistics about class construction.
+        Statistics gathered earlier are kept until reset.
+    """
+    global _monitor
+    if _monitor is None:
+        _monitor = _instrumentation()
+
+def disable_instrumentation():
+    """ Stops gathering statistics and discards them """
+    global _monitor
+    _monitor = None
+
+def instrumentation_snapshot(reset=False):
+    """ Returns the gathered statistics as a plain dict, or None when
+        instrumentation is disabled.
+
+        {'classes': {'calls': 2, 'seconds': 0.0001, 'max_seconds': 0.00006},
+         'helpers': {'includes': {'calls': 1, ...}, 'metaclass': {...}},
+         'includes_attributes': 12,
+         'patches_setattrs': 0}
+    """
+    global _monitor
+    monitor = _monitor
+    if monitor is None:
+        return None
+    if reset:
+        _monitor = _instrumentation()
+    return monitor.snapshot()
+
+def add_construction_hook(pre=None, post=None):
+    """ Registers hooks called around every class construction while
+        instrumentation is enabled.
+
+        pre(name, surrogates_or_bases, dct) runs before the helpers,
+        post(cls, seconds) runs once the class has been built.
+    """
+    with _hooks_lock:
+        if pre is not None:
+            _hooks['pre'] += (pre,)
+        if post is not None:
+            _hooks['post'] += (post,)
+
+def remove_construction_hook(pre=None, post=None):
+    with _hooks_lock:
+        for when, hook in (('pre', pre), ('post', post)):
+            if hook is not None:
+                hooks = list(_hooks[when])
+                hooks.remove(hook)
+                _hooks[when] = tuple(hooks)
+
+def finalize(force_lazy=True, freeze=True):
+    """ Prepares a process for forking workers, once every class has been
+        imported.  Pending lazy() classes are built, unless force_lazy is
+        False, so the workers do not each build them.  Then the internal
+        caches are dropped, along with any surrogates left unused.  Finally
+        everything alive is moved out of reach of the garbage collector
+        with gc.freeze(), where available.  Collections in the workers
+        then no longer write to, and so copy, the memory shared with the
+        parent.
+
+        Returns what was released, e.g.
+        {'lazy_classes': 3, 'surrogates': 41, 'mixin_plans': 12,
+         'construction_plans': 9, 'frozen': 51234}
+
+        Classes can still be built afterwards, the caches refill as
+        needed.
+    """
+    released = {'lazy_classes': force_all() if force_lazy else 0}
+    for key, cache in (('surrogates', _interned), ('mixin_plans', _mixin_plans),
+                       ('construction_plans', _construction_plans)):
+        released[key] = len(cache)
+        cache.clear()
+    _shapes.clear()
+    gc.collect()
+    frozen = 0
+    if freeze and hasattr(gc, 'freeze'):
+        gc.freeze()
+        frozen = gc.get_freeze_count()
+    released['frozen'] = frozen
+    return released
+
+def patches(value_or_array, into=None):
     """ Allows for inline monkey patching of classes
 
         Point = collections.namedtuple('Point',('x','y'))
@@ -159,10 +2102,17 @@ def patches(value_or_array):
                 return (self.x**2 + self.y**2) ** 0.5
 
         assert Point is orinal_class #True
+
+        Every attribute is written, or none are.  If into is a
+        patch_set, the changes are recorded there instead, to be applied
+        (and reverted) together with the rest of the set.
     """
+    if into is not None:
+        return class_helper_meta._wrap('patches', value_or_array, solo=True,
+                                       _target=into)
     return class_helper_meta._wrap('patches', value_or_array, solo=True)
 
-def includes(value_or_array):
+def includes(value_or_array, lazy=False, track=False):
     """ Allows simple inline composition at class delaration time.
 
         class Toyota(Car, includes(Warranty)):
@@ -170,7 +2120,26 @@ def includes(value_or_array):
 
         issubclass(Toyota, Car) # True
         issubclass(Toyota, Warranty) # False
+
+        With lazy=True most attributes are only copied into the class
+        the first time an instance looks them up, so values are copied
+        on first use rather than at declaration.  Special methods,
+        classmethods and staticmethods are copied at once.  Other class
+        level access, e.g. Toyota.claim, needs materialize(Toyota) to be
+        called first.
+        Subclassing does that by itself from Python 3.6, before that
+        call materialize(Toyota) before subclasses use super().
+
+        With track=True later changes to Warranty, made through patches()
+        or followed by propagate(Warranty), are pushed into Toyota.  Names
+        Toyota defines or overrides itself are left alone.
     """
+    if lazy and track:
+        raise TypeError("includes cannot be both lazy and tracked")
+    if track:
+        return class_helper_meta._wrap('tracked_includes', value_or_array)
+    if lazy:
+        return class_helper_meta._wrap('lazy_includes', value_or_array)
     return class_helper_meta._wrap('includes', value_or_array)
 
 def metaclass(value_or_array):
@@ -223,6 +2192,144 @@ def decorate(value_or_array):
     """
     return class_helper_meta._wrap('decorate', value_or_array)
 
+def lazy():
+    """ Defers building the class until it is first really used.  The
+        class statement only records its name, bases and body, and
+        returns a placeholder.  Instantiating it, reading or writing its
+        attributes, isinstance and issubclass checks and subclassing it
+        all build the real class, running every other helper then.
+
+        class Plugin(lazy(), includes(Heavy), Base):
+            pass
+
+        Plugin()          # builds Plugin
+        force(Plugin)     # the real class
+        force_all()       # builds every lazy class still pending
+
+        Once built, a module level placeholder is replaced by the class.
+        Methods should use super() without arguments, since any other
+        name for the class may still refer to the placeholder.  Not to
+        be confused with includes(..., lazy=True), which builds
+        the class at once and defers copying attributes.
+
+        Before Python 3.7 a placeholder could not be subclassed, so the
+        class is built at once there.
+    """
+    return _deferred_meta._wrap('lazy', ())
+
+def portable():
+    """ Lets instances of a class built at run time be pickled, e.g. to
+        send them to a process pool, even though the class cannot be
+        imported by name.  The class records how it was built, and the
+        receiving process builds it again from that, once.
+
+        def make_handler(route):
+            return type('Handler', (portable(), includes(Base)), {'route': route})
+
+        pool.map(handle, [make_handler('/users')() for _ in range(100)])
+
+        Everything the class is built from is pickled by reference or by
+        value, so bases, mixins and metaclasses must be importable or
+        portable themselves, and the namespace may only hold picklable
+        values such as data and module level functions.  Methods belong
+        in the included mixins.  Classes built the same way are one and
+        the same class once unpickled.
+    """
+    return _portable_meta._wrap('portable', ())
+
+def build_classes(specs, stats=None):
+    """ Builds many classes in one pass, sharing helper resolution.
+
+        specs = [('Toyota', (Car,), (includes(Warranty),), {}),
+                 ('Honda', (Car,), (includes(Warranty),), {})]
+        Toyota, Honda = build_classes(specs)
+
+        If a dict is passed as stats, it is updated with the number of
+        classes built and the seconds the batch took.
+    """
+    start = default_timer()
+    classes = class_helper_meta.build_many(specs)
+    if stats is not None:
+        stats['classes'] = len(classes)
+        stats['seconds'] = default_timer() - start
+    return classes
+
+def slots(value_or_array=()):
+    """ Gives the class a merged __slots__, built from its own body,
+        every included mixin and any extra names given here.  Slots
+        already provided by a base class are left out.
+
+        class Point(includes(XY), slots('z')):
+            __slots__ = ('label',)
+
+        Point.__slots__ # ('label', 'x', 'y', 'z')
+    """
+    if isinstance(value_or_array, str):
+        value_or_array = (value_or_array,)
+    return class_helper_meta._wrap('slots', value_or_array)
+
+def memoize(value_or_array, maxsize=128, ttl=None):
+    """ Caches the results of the named methods and properties, keyed on
+        the instance itself, not what it compares equal to, and the
+        arguments, which must be hashable.  At most maxsize results are
+        kept per attribute (None for no limit), each for at most ttl
+        seconds (None to keep them until evicted).  An instance's results
+        are forgotten when it dies, so classes with __slots__ are given a
+        __weakref__ slot.  Instances which cannot have one, e.g. of
+        namedtuples, are kept alive by their results until maxsize
+        evicts them.
+
+        class Person(memoize('full_name', maxsize=1024)):
+            @property
+            def full_name(self):
+                return '%s %s' % (self.first, self.last)
+
+        Setting or deleting a memoized property forgets the instance's
+        result, and so does invalidate().  Patching the class forgets
+        every result.  See cache_info() for hit and miss counts.
+    """
+    if isinstance(value_or_array, str):
+        value_or_array = (value_or_array,)
+    return class_helper_meta._wrap('memoize', value_or_array, maxsize=maxsize, ttl=ttl)
+
+def flatten(value_or_array=()):
+    """ Copies the attributes a class inherits into its own __dict__, so
+        lookups on deep hierarchies stop at the first class searched.
+        Inheritance is unchanged, and anything the class body defines is
+        kept.  Only the given names are copied, if any are given.
+
+        class Square(inherits(Rectangle), flatten()):
+            pass
+
+        'area' in Square.__dict__ # True
+        issubclass(Square, Rectangle) # True
+
+        The copies go stale when a base changes, see reflatten().
+    """
+    if isinstance(value_or_array, str):
+        value_or_array = (value_or_array,)
+    return class_helper_meta._wrap('flatten', value_or_array)
+
+def record(value_or_array):
+    """ Generates __init__, __eq__, __ne__, __hash__, __repr__, __len__,
+        __iter__ and __getitem__ for the given fields, and stores the
+        fields in __slots__.  Values the class body gives the fields
+        become their defaults, and methods it defines are kept.
+
+        class Point(record(['x', 'y'])):
+            y = 0
+            def norm(self):
+                return abs(self.x) + abs(self.y)
+
+        Point(3) # Point(x=3, y=0)
+
+        On patches(...) classes the methods are generated, but the
+        instance layout of the existing class is left alone.
+    """
+    if isinstance(value_or_array, str):
+        value_or_array = (value_or_array,)
+    return class_helper_meta._wrap('record', value_or_array)
+
 def py3(*bases, **dct):
     """ Allows Python3 syntax to be ported into Python2 class definitions.
         class Person(py3(A, B, metaclass=ABCMeta)):
@@ -0,0 +1,217 @@
+""" Reports which class statements spend the most time and memory inside
+    class_helper_meta while a module, and every module below it, is
+    imported.
+
+    python -m class_helpers.profile mypackage
+    python -m class_helpers.profile mypackage --json --top 50
+
+    Each class is listed with the seconds spent building it, the memory
+    it still holds afterwards, the attributes copied by includes and
+    patches, and the seconds spent in each helper.  Helpers given
+    through py3/py2 also count towards py6.
+
+    residue() measures what building and discarding classes over and
+    over leaves behind, to catch leaks in long running processes.
+"""
+from class_helpers import class_helper_meta, instrumentation_snapshot
+from class_helpers import enable_instrumentation, disable_instrumentation
+from class_helpers import add_construction_hook, remove_construction_hook
+import importlib
+import threading
+import argparse
+import pkgutil
+import json
+import sys
+import gc
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__all__ = ['profiler', 'residue', 'main']
+
+_COUNTERS = ('includes_attributes', 'patches_setattrs')
+
+class profiler(object):
+    """ Records every class built through class_helper_meta between
+        start() and stop(), one dict per class statement in records.
+    """
+    def __init__(self, memory=True):
+        self.memory = memory and tracemalloc is not None
+        self.records = []
+        self.errors = []
+        self.local = threading.local()
+        self.started_instrumentation = False
+        self.started_tracing = False
+
+    def start(self):
+        if instrumentation_snapshot() is None:
+            enable_instrumentation()
+            self.started_instrumentation = True
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        add_construction_hook(self.pre, self.post)
+
+    def stop(self):
+        remove_construction_hook(self.pre, self.post)
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        if self.started_instrumentation:
+            disable_instrumentation()
+            self.started_instrumentation = False
+
+    def pre(self, name, surrogates_or_bases, dct):
+        stack = self.local.__dict__.setdefault('stack', [])
+        qualname = dct.get('__qualname__', name)
+        record = {'class': '%s.%s' % (dct.get('__module__', '?'), qualname),
+                  'helpers_used': [item.name for item in surrogates_or_bases
+                                   if isinstance(item, class_helper_meta)]}
+        memory = tracemalloc.get_traced_memory()[0] if self.memory else None
+        stack.append((record, instrumentation_snapshot(), memory))
+
+    def post(self, cls, seconds):
+        record, before, memory = self.local.stack.pop()
+        after = instrumentation_snapshot()
+        if memory is not None:
+            record['bytes'] = tracemalloc.get_traced_memory()[0] - memory
+        record['seconds'] = seconds
+        record['attributes'] = dict((name, after[name] - before[name])
+                                    for name in _COUNTERS)
+        helpers = {}
+        for name, timing in after['helpers'].items():
+            earlier = before['helpers'].get(name, {'calls': 0, 'seconds': 0.0})
+            if timing['calls'] != earlier['calls']:
+                helpers[name] = timing['seconds'] - earlier['seconds']
+        record['helpers'] = helpers
+        self.records.append(record)
+
+    def import_tree(self, name, recurse=True):
+        """ Imports name and, for packages, every module below it.
+            Failures below the top module are kept in errors.
+        """
+        module = importlib.import_module(name)
+        if recurse and hasattr(module, '__path__'):
+            def failed(name):
+                self.errors.append((name, str(sys.exc_info()[1])))
+            prefix = module.__name__ + '.'
+            for info in pkgutil.walk_packages(module.__path__, prefix, failed):
+                try:
+                    importlib.import_module(info[1])
+                except Exception as e:
+                    self.errors.append((info[1], str(e)))
+        return module
+
+    def report(self, top=20, sort='seconds'):
+        """ A JSON serializable summary of the records """
+        records = sorted(self.records, key=lambda record: record.get(sort, 0),
+                         reverse=True)
+        helpers = {}
+        for record in self.records:
+            for name, seconds in record['helpers'].items():
+                totals = helpers.setdefault(name, {'classes': 0, 'seconds': 0.0})
+                totals['classes'] += 1
+                totals['seconds'] += seconds
+        total = {'classes': len(self.records),
+                 'seconds': sum(record['seconds'] for record in self.records),
+                 'attributes': dict((name, sum(record['attributes'][name]
+                                               for record in self.records))
+                                    for name in _COUNTERS)}
+        if self.memory:
+            total['bytes'] = sum(record['bytes'] for record in self.records)
+        return {'total': total, 'helpers': helpers, 'classes': records[:top],
+                'errors': [{'module': name, 'error': error}
+                           for name, error in self.errors]}
+
+def format_report(report):
+    """ The report from profiler.report as a human readable table """
+    total = report['total']
+    lines = ['%d classes built through class_helpers in %.6fs'
+             % (total['classes'], total['seconds'])]
+    if 'bytes' in total:
+        lines[0] += ', holding %.1f KiB' % (total['bytes'] / 1024.0)
+    lines.append('')
+    lines.append('%10s %10s %7s  %-40s %s' % ('seconds', 'KiB', 'attrs', 'class', 'helpers'))
+    for record in report['classes']:
+        kib = '-'
+        if 'bytes' in record:
+            kib = '%.1f' % (record['bytes'] / 1024.0)
+        helpers = ', '.join('%s %.6f' % item for item in sorted(record['helpers'].items()))
+        lines.append('%10.6f %10s %7d  %-40s %s' % (
+            record['seconds'], kib, sum(record['attributes'].values()),
+            record['class'], helpers))
+    lines.append('')
+    lines.append('%-20s %8s %10s' % ('helper', 'classes', 'seconds'))
+    for name, totals in sorted(report['helpers'].items(),
+                               key=lambda item: -item[1]['seconds']):
+        lines.append('%-20s %8d %10.6f' % (name, totals['classes'], totals['seconds']))
+    for error in report['errors']:
+        lines.append('failed to import %(module)s: %(error)s' % error)
+    return '\n'.join(lines)
+
+def residue(build, number=1000, rounds=3, memory=True):
+    """ Bytes and garbage collected objects left behind per call of
+        build(i), for a build which makes a class and throws it away.
+
+        residue(lambda i: type('C', (includes(Mixin),), {}))
+        # {'calls': 1000, 'bytes': 0.4, 'objects': 0.0}
+
+        build is called number times per round.  The first round fills
+        caches and is left out, and of the others the round growing the
+        least counts, since a leak grows every round while a cache being
+        resized grows only one.  bytes is None without tracemalloc.
+    """
+    memory = memory and tracemalloc is not None
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        totals = []
+        for _ in range(max(rounds, 2)):
+            for i in range(number):
+                build(i)
+            gc.collect()
+            traced = tracemalloc.get_traced_memory()[0] if memory else 0
+            totals.append((traced, len(gc.get_objects())))
+    finally:
+        if started:
+            tracemalloc.stop()
+    growth = [(after[0] - before[0], after[1] - before[1])
+              for before, after in zip(totals, totals[1:])]
+    result = {'calls': number, 'bytes': None,
+              'objects': min(objects for _, objects in growth) / float(number)}
+    if memory:
+        result['bytes'] = min(traced for traced, _ in growth) / float(number)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m class_helpers.profile',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('modules', nargs='+', help='modules or packages to import')
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    parser.add_argument('--top', type=int, default=20, help='classes to list')
+    parser.add_argument('--sort', choices=('seconds', 'bytes'), default='seconds')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip tracemalloc, which slows imports down')
+    parser.add_argument('--no-recurse', action='store_true',
+                        help='only import the named modules')
+    args = parser.parse_args(argv)
+
+    profile = profiler(memory=not args.no_memory)
+    profile.start()
+    try:
+        for name in args.modules:
+            profile.import_tree(name, recurse=not args.no_recurse)
+    finally:
+        profile.stop()
+    report = profile.report(args.top, args.sort)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,34 @@
 from class_helpers import class_helper_meta, patches, decorate
 from class_helpers import metaclass, inherits, includes, py3, py2
+from class_helpers import build_classes, materialize, patch_set, slots
+from class_helpers import flatten, reflatten
+from class_helpers import memoize, cache_info, invalidate, columnar, propagate
+from class_helpers import lazy, force, force_all, class_cache, cached_class
+from class_helpers import finalize, record, hot_reload, portable
+from class_helpers.profile import residue
+import class_helpers
+from class_helpers import enable_instrumentation, disable_instrumentation
+from class_helpers import instrumentation_snapshot
+from class_helpers import add_construction_hook, remove_construction_hook
 from collections import namedtuple, Sized, Iterable, Container
 from abc import ABCMeta, abstractmethod
 from operator import itemgetter
 from functools import wraps
 import unittest
+import threading
+import tempfile
+import shutil
+import os
+import weakref
+import types
+import json
+import sys
+import gc
+import pickle
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 class BasePerson(object):
     def __init__(self, *args):
@@ -375,5 +399,1464 @@ class test_class_decorator_wrapper(unittest.TestCase):
     def decorator_does_not_change_too_much(self):
         self.assertEqual(self.Foo.x, 3)
 
+class test_surrogate_interning(unittest.TestCase):
+    def setUp(self):
+        class Mixin(object):
+            x = 3
+        self.Mixin = Mixin
+
+    def tearDown(self):
+        del self.Mixin
+
+    def test_identical_helpers_share_a_surrogate(self):
+        self.assertIs(includes(self.Mixin), includes([self.Mixin]))
+
+    def test_different_helpers_do_not_share_a_surrogate(self):
+        self.assertIsNot(includes(self.Mixin), inherits(self.Mixin))
+
+    def test_py3_surrogates_are_shared(self):
+        self.assertIs(py3(self.Mixin, metaclass=ABCMeta),
+                      py3(self.Mixin, metaclass=ABCMeta))
+
+    def test_decorators_are_not_interned(self):
+        decorator = wraps(self.Mixin)
+        self.assertIsNot(decorate(decorator), decorate(decorator))
+
+    def test_interned_surrogate_still_builds_classes(self):
+        surrogate = includes(self.Mixin)
+        class A(surrogate):
+            pass
+        class B(surrogate):
+            pass
+        self.assertEqual((A.x, B.x), (3, 3))
+        self.assertIsNot(A, B)
+
+    def test_surrogate_evicted_when_argument_dies(self):
+        class Temporary(object):
+            pass
+        class A(includes(Temporary)):
+            pass
+        ref = weakref.ref(includes(Temporary))
+        class B(ref()):
+            pass
+        del Temporary, A, B
+        gc.collect() # Collects the surrogate along with Temporary
+        self.assertIsNone(ref())
+
+    def test_stored_helper_outlives_collection(self):
+        helper = includes(type('Inline', (object,), {'x': 1}))
+        class A(helper):
+            pass
+        gc.collect()
+        class B(helper):
+            pass
+        self.assertEqual((A.x, B.x), (1, 1))
+
+    def evicted(self, make):
+        ref = weakref.ref(make())
+        gc.collect()
+        return ref() is None
+
+    def test_failed_statement_releases_arguments(self):
+        def make():
+            class Temporary(object):
+                pass
+            with self.assertRaises(TypeError):
+                class Broken(includes(Temporary), patches(self.Mixin)):
+                    pass
+            return Temporary
+        self.assertTrue(self.evicted(make))
+
+    def test_unused_surrogate_releases_arguments(self):
+        def make():
+            class Temporary(object):
+                pass
+            includes(Temporary)
+            class Unrelated(includes(self.Mixin)):
+                pass
+            return Temporary
+        self.assertTrue(self.evicted(make))
+
+    def test_lazy_class_keeps_arguments(self):
+        class Pending(lazy(), includes(type('Inline', (object,), {'y': 4}))):
+            pass
+        class Unrelated(includes(self.Mixin)):
+            pass
+        gc.collect()
+        self.assertEqual(Pending.y, 4)
+
+class test_includes_attribute_cache(unittest.TestCase):
+    def setUp(self):
+        class Base(object):
+            x, y = 1, 2
+        class Mixin(Base):
+            y = 3
+        self.Base, self.Mixin = Base, Mixin
+
+    def tearDown(self):
+        del self.Base, self.Mixin
+
+    def make_class(self):
+        class Thing(includes(self.Mixin)):
+            pass
+        return Thing
+
+    def test_per_class_descriptors_are_not_copied(self):
+        Thing = self.make_class()
+        self.assertIsNot(Thing.__dict__['__dict__'], self.Base.__dict__['__dict__'])
+        thing = Thing()
+        thing.z = 4
+        self.assertEqual(vars(thing), {'z': 4})
+
+    def test_matches_uncached_resolution(self):
+        first, second = self.make_class(), self.make_class()
+        self.assertEqual((first.x, first.y), (second.x, second.y))
+
+    def test_added_attribute_invalidates_cache(self):
+        self.make_class()
+        self.Base.z = 5
+        self.assertEqual(self.make_class().z, 5)
+
+    def test_deleted_attribute_invalidates_cache(self):
+        self.make_class()
+        del self.Base.x
+        self.assertNotIn('x', self.make_class().__dict__)
+
+    def test_replaced_value_is_picked_up(self):
+        self.make_class()
+        self.Base.x = 10
+        self.assertEqual(self.make_class().x, 10)
+
+    def test_changed_bases_invalidate_cache(self):
+        self.make_class()
+        class Other(object):
+            w = 6
+        self.Mixin.__bases__ = (Other,)
+        Thing = self.make_class()
+        self.assertEqual(Thing.w, 6)
+        self.assertNotIn('x', Thing.__dict__)
+
+class test_build_classes(unittest.TestCase):
+    def setUp(self):
+        class Mixin(object):
+            x = 3
+        class Base(object):
+            pass
+        self.Mixin, self.Base = Mixin, Base
+
+    def tearDown(self):
+        del self.Mixin, self.Base
+
+    def test_builds_one_class_per_spec(self):
+        helpers = (includes(self.Mixin), metaclass(ABCMeta))
+        specs = [('Model%d' % i, (self.Base,), helpers, {'i': i})
+                 for i in range(5)]
+        classes = build_classes(specs)
+        self.assertEqual([c.__name__ for c in classes],
+                         ['Model%d' % i for i in range(5)])
+        for i, cls in enumerate(classes):
+            self.assertIs(type(cls), ABCMeta)
+            self.assertTrue(issubclass(cls, self.Base))
+            self.assertEqual((cls.x, cls.i), (3, i))
+
+    def test_many_specs_with_inline_mixins(self):
+        specs = [('Model%d' % i, (self.Base,),
+                  (includes(type('Fields%d' % i, (object,), {'i': i})),), {})
+                 for i in range(200)]
+        gc.collect()
+        classes = build_classes(specs)
+        self.assertEqual([cls.i for cls in classes], list(range(200)))
+
+    def test_matches_class_statement(self):
+        helpers = (inherits(self.Base), includes(self.Mixin))
+        class Expected(inherits(self.Base), includes(self.Mixin)):
+            x = 4
+        (Actual,) = build_classes([('Expected', (), helpers, {'x': 4})])
+        self.assertEqual(Actual.__bases__, Expected.__bases__)
+        self.assertEqual(Actual.x, Expected.x)
+
+    def test_inherits_conflicts_with_bases(self):
+        specs = [('Thing', (object,), (inherits(self.Base),), {})]
+        self.assertRaises(TypeError, build_classes, specs)
+
+    def test_handles_decorate_per_class(self):
+        def tag(cls):
+            cls.tagged = True
+        helpers = (decorate(tag),)
+        A, B = build_classes([('A', (), helpers, {}), ('B', (), helpers, {})])
+        self.assertTrue(A.tagged and B.tagged)
+
+    def test_reports_batch_stats(self):
+        stats = {}
+        build_classes([('A', (), (), {}), ('B', (), (), {})], stats)
+        self.assertEqual(stats['classes'], 2)
+        self.assertGreaterEqual(stats['seconds'], 0)
+
+class test_construction_plans(unittest.TestCase):
+    def compile(self, *surrogates):
+        return class_helper_meta._compile(surrogates)
+
+    def test_py6_is_flattened(self):
+        class A(object):
+            pass
+        expansions, steps = self.compile(py3(A, metaclass=ABCMeta, includes=A))
+        self.assertEqual(expansions, ((0, 0),))
+        names = [func.__name__ for func, frame, index in steps]
+        self.assertEqual(names, ['_unwrap_includes', '_unwrap_metaclass',
+                                 '_unwrap_inherits'])
+        self.assertEqual([(frame, index) for func, frame, index in steps],
+                         [(1, 2), (1, 1), (1, 0)])
+
+    def test_shape_ignores_argument_values(self):
+        class A(object):
+            pass
+        class B(object):
+            pass
+        self.assertEqual(includes(A)._shape, includes([B])._shape)
+        self.assertNotEqual(includes(A)._shape, inherits(A)._shape)
+
+    def test_solo_helpers_rejected_on_every_use(self):
+        def attempt():
+            class Thing(object):
+                pass
+            class Thing(patches(Thing), metaclass(type)):
+                pass
+        self.assertRaises(TypeError, attempt)
+        self.assertRaises(TypeError, attempt)
+
+    def test_plan_is_reused_with_different_arguments(self):
+        class A(object):
+            x = 1
+        class B(object):
+            x = 2
+        class First(includes(A), metaclass(ABCMeta)):
+            pass
+        class Second(includes(B), metaclass(type)):
+            pass
+        self.assertEqual((First.x, type(First)), (1, ABCMeta))
+        self.assertEqual((Second.x, type(Second)), (2, type))
+
+class test_decorate_journal(unittest.TestCase):
+    def test_decorator_can_delete_attributes(self):
+        def strip(cls):
+            del cls.x
+        class Thing(decorate(strip)):
+            x, y = 1, 2
+        self.assertFalse(hasattr(Thing, 'x'))
+        self.assertEqual(Thing.y, 2)
+
+    def test_deleting_a_missing_attribute_raises(self):
+        def strip(cls):
+            del cls.missing
+        def attempt():
+            class Thing(decorate(strip)):
+                pass
+        self.assertRaises(AttributeError, attempt)
+
+    def test_decorator_sees_class_body(self):
+        def double(cls):
+            cls.x = cls.x * 2
+        class Thing(decorate(double)):
+            x = 3
+        self.assertEqual(Thing.x, 6)
+
+    def test_stacked_decorators_see_earlier_changes(self):
+        def first(cls):
+            cls.log = ['first']
+        def second(cls):
+            cls.log = cls.log + ['second']
+        class Thing(decorate([second, first])):
+            pass
+        self.assertEqual(Thing.log, ['first', 'second'])
+
+    def test_changes_detected_without_equality(self):
+        class Fussy(object):
+            def __eq__(self, other):
+                raise AssertionError("compared with ==")
+            __ne__ = __eq__
+        value = Fussy()
+        def assign(cls):
+            cls.value = value
+        class Thing(decorate(assign)):
+            pass
+        self.assertIs(Thing.value, value)
+
+    def test_namespace_class_is_reused(self):
+        seen = []
+        def spy(cls):
+            seen.append(type(cls))
+        class First(decorate(spy)):
+            pass
+        class Second(decorate(spy)):
+            pass
+        self.assertIs(seen[0], seen[1])
+
+class test_instrumentation(unittest.TestCase):
+    def setUp(self):
+        enable_instrumentation()
+        instrumentation_snapshot(reset=True)
+
+    def tearDown(self):
+        disable_instrumentation()
+
+    def test_disabled_snapshot_is_none(self):
+        disable_instrumentation()
+        self.assertIsNone(instrumentation_snapshot())
+
+    def test_counts_classes_and_helpers(self):
+        class Mixin(object):
+            x, y = 1, 2
+        class Thing(includes(Mixin), metaclass(ABCMeta)):
+            pass
+        stats = instrumentation_snapshot()
+        self.assertEqual(stats['classes']['calls'], 1)
+        self.assertEqual(stats['helpers']['includes']['calls'], 1)
+        self.assertEqual(stats['helpers']['metaclass']['calls'], 1)
+        self.assertGreaterEqual(stats['helpers']['includes']['max_seconds'], 0)
+        self.assertEqual(stats['includes_attributes'], len(vars(Mixin)) - 2)
+
+    def test_counts_patched_attributes(self):
+        class Thing(object):
+            pass
+        type('Thing', (patches(Thing),), {'a': 1, 'b': 2})
+        stats = instrumentation_snapshot()
+        self.assertEqual(stats['patches_setattrs'], 2)
+
+    def test_snapshot_reset(self):
+        class Thing(metaclass(type)):
+            pass
+        self.assertEqual(instrumentation_snapshot(reset=True)['classes']['calls'], 1)
+        self.assertEqual(instrumentation_snapshot()['classes']['calls'], 0)
+
+    def test_hooks_run_around_construction(self):
+        calls = []
+        pre = lambda name, bases, dct: calls.append(('pre', name))
+        post = lambda cls, seconds: calls.append(('post', cls.__name__))
+        add_construction_hook(pre, post)
+        try:
+            class Thing(metaclass(type)):
+                pass
+            build_classes([('Other', (), (), {})])
+        finally:
+            remove_construction_hook(pre, post)
+        self.assertEqual(calls, [('pre', 'Thing'), ('post', 'Thing'),
+                                 ('pre', 'Other'), ('post', 'Other')])
+
+class test_lazy_includes(unittest.TestCase):
+    def setUp(self):
+        class Base(object):
+            shared = 'base'
+        class Left(object):
+            x, y = 'left x', 'left y'
+            def method(self):
+                return 'left method'
+            def __len__(self):
+                return 3
+        class Right(object):
+            x, z = 'right x', 'right z'
+            shared = 'right'
+        class Thing(Base, includes([Left, Right], lazy=True)):
+            y = 'body y'
+        self.Left, self.Right, self.Thing = Left, Right, Thing
+
+    def tearDown(self):
+        del self.Left, self.Right, self.Thing
+
+    def test_attributes_not_copied_up_front(self):
+        self.assertNotIn('method', self.Thing.__dict__)
+        self.assertNotIn('z', self.Thing.__dict__)
+
+    def test_attribute_copied_on_first_lookup(self):
+        thing = self.Thing()
+        self.assertEqual(thing.method(), 'left method')
+        self.assertIn('method', self.Thing.__dict__)
+
+    def test_class_level_methods_copied_up_front(self):
+        class Factory(object):
+            @classmethod
+            def make(cls):
+                return cls()
+            @staticmethod
+            def helper():
+                return 'helper'
+        class A(includes(Factory, lazy=True)):
+            pass
+        self.assertIsInstance(A.make(), A)
+        self.assertEqual(A.helper(), 'helper')
+        self.assertTrue(hasattr(A, 'helper'))
+
+    def test_left_mixins_have_priority(self):
+        self.assertEqual(self.Thing().x, 'left x')
+
+    def test_mixins_override_class_body(self):
+        self.assertEqual(self.Thing.y, 'left y')
+
+    def test_mixins_override_inheritance(self):
+        self.assertEqual(self.Thing.shared, 'right')
+
+    def test_special_methods_copied_up_front(self):
+        self.assertEqual(len(self.Thing()), 3)
+
+    def test_values_copied_not_referenced(self):
+        self.assertEqual(self.Thing().z, 'right z')
+        self.Right.z = 'changed'
+        self.assertEqual(self.Thing().z, 'right z')
+
+    def test_missing_attribute_raises(self):
+        self.assertRaises(AttributeError, getattr, self.Thing(), 'missing')
+
+    def test_materialize_enables_class_access(self):
+        materialize(self.Thing)
+        self.assertEqual(self.Thing.z, 'right z')
+
+    def test_falls_back_to_own_getattr(self):
+        class Dynamic(includes(self.Right, lazy=True)):
+            def __getattr__(self, key):
+                return 'dynamic ' + key
+        dynamic = Dynamic()
+        self.assertEqual(dynamic.z, 'right z')
+        self.assertEqual(dynamic.other, 'dynamic other')
+
+    def test_implements_abstract_methods(self):
+        class Abstract(metaclass(ABCMeta)):
+            @abstractmethod
+            def run(self):
+                pass
+        class Impl(object):
+            def run(self):
+                return 'ran'
+        class Lazy(Abstract, includes(Impl, lazy=True)):
+            pass
+        self.assertEqual(Lazy().run(), 'ran')
+
+    @unittest.skipUnless(hasattr(object, '__init_subclass__'), "needs __init_subclass__")
+    def test_super_from_subclass(self):
+        class Child(self.Thing):
+            def method(self):
+                return 'child ' + super(Child, self).method()
+        self.assertEqual(Child().method(), 'child left method')
+
+class test_patch_set(unittest.TestCase):
+    def setUp(self):
+        class Point(object):
+            x = 1
+            def describe(self):
+                return 'point'
+        class Line(object):
+            pass
+        self.Point, self.Line = Point, Line
+
+    def tearDown(self):
+        del self.Point, self.Line
+
+    def make_patch(self):
+        patch = patch_set()
+        class Point(patches(self.Point, into=patch)):
+            def describe(self):
+                return 'patched'
+        patch.add(self.Line, {'length': 5})
+        return patch
+
+    def test_patches_into_set_are_deferred(self):
+        self.make_patch()
+        self.assertEqual(self.Point().describe(), 'point')
+        self.assertFalse(hasattr(self.Line, 'length'))
+
+    def test_apply_patches_every_class(self):
+        self.make_patch().apply()
+        self.assertEqual(self.Point().describe(), 'patched')
+        self.assertEqual(self.Line.length, 5)
+
+    def test_revert_restores_every_class(self):
+        original = self.Point.__dict__['describe']
+        self.make_patch().apply().revert()
+        self.assertIs(self.Point.__dict__['describe'], original)
+        self.assertNotIn('length', self.Line.__dict__)
+
+    def test_scoped_patch(self):
+        with self.make_patch() as patch:
+            self.assertTrue(patch.applied)
+            self.assertEqual(self.Line.length, 5)
+        self.assertFalse(patch.applied)
+        self.assertFalse(hasattr(self.Line, 'length'))
+
+    def test_failed_write_rolls_back(self):
+        patch = patch_set()
+        patch.add(self.Line, {'length': 5})
+        patch.add(self.Point, {'__name__': None})
+        self.assertRaises(TypeError, patch.apply)
+        self.assertFalse(patch.applied)
+        self.assertNotIn('length', self.Line.__dict__)
+
+    def test_cannot_apply_twice(self):
+        patch = self.make_patch().apply()
+        self.assertRaises(RuntimeError, patch.apply)
+        self.assertRaises(RuntimeError, patch.add, self.Line, {})
+
+    @unittest.skipUnless(hasattr(sys, 'getswitchinterval'), "needs sys.getswitchinterval")
+    def test_leaves_switch_interval_alone(self):
+        seen = []
+        class Recording(type):
+            def __setattr__(cls, key, value):
+                seen.append(sys.getswitchinterval())
+                type.__setattr__(cls, key, value)
+        Target = Recording('Target', (object,), {})
+        class Target(patches(Target)):
+            x = 1
+        self.assertEqual(set(seen), set([sys.getswitchinterval()]))
+
+class test_concurrent_construction(unittest.TestCase):
+    threads = 8
+    classes_per_thread = 100
+
+    def test_every_helper_from_many_threads(self):
+        class Mixin(object):
+            x = 1
+        class Base(object):
+            pass
+        def tag(cls):
+            cls.tagged = True
+        start = threading.Event()
+        errors, built = [], []
+
+        def work(n):
+            try:
+                start.wait()
+                for i in range(self.classes_per_thread):
+                    class Target(object):
+                        pass
+                    class Target(patches(Target)):
+                        y = i
+                    class Thing(py3(Base, metaclass=ABCMeta, includes=Mixin),):
+                        pass
+                    class Other(inherits(Base), includes(Mixin, lazy=True),
+                                decorate(tag), metaclass(type)):
+                        pass
+                    built.append((Target.y == i, Thing.x, Other().x,
+                                  Other.tagged, type(Thing)))
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=work, args=(n,))
+                   for n in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(built), self.threads * self.classes_per_thread)
+        self.assertEqual(set(built), {(True, 1, 1, True, ABCMeta)})
+
+class test_slots(unittest.TestCase):
+    def setUp(self):
+        class XY(object):
+            __slots__ = ('x', 'y')
+            def norm(self):
+                return abs(self.x) + abs(self.y)
+        self.XY = XY
+
+    def test_included_slots_make_compact_instances(self):
+        class Point(includes(self.XY), slots()):
+            pass
+        p = Point()
+        p.x, p.y = 3, -4
+        self.assertEqual(Point.__slots__, ('x', 'y'))
+        self.assertEqual(p.norm(), 7)
+        self.assertFalse(hasattr(p, '__dict__'))
+
+    def test_body_and_extra_names_are_merged_once(self):
+        class Point(includes(self.XY), slots(['z', 'x'])):
+            __slots__ = ('label', 'y')
+        self.assertEqual(Point.__slots__, ('label', 'y', 'x', 'z'))
+
+    def test_base_slots_are_not_redeclared(self):
+        class Base(object):
+            __slots__ = ('x', '__weakref__')
+        class Point(Base, includes(self.XY), slots('__weakref__')):
+            pass
+        self.assertEqual(Point.__slots__, ('y',))
+        weakref.ref(Point())
+
+    def test_includes_without_slots_keeps_a_dict(self):
+        class Point(includes(self.XY)):
+            pass
+        p = Point()
+        p.x, p.label = 1, 'a'
+        self.assertNotIn('__slots__', Point.__dict__)
+        self.assertEqual(p.label, 'a')
+
+class test_lightweight_surrogates(unittest.TestCase):
+    def test_surrogates_carry_no_layout_or_abc_state(self):
+        surrogate = decorate(lambda cls: cls)
+        self.assertEqual((surrogate.name, surrogate.solo), ('decorate', False))
+        for key in ('__dict__', '__weakref__', '_abc_impl', '_abc_registry'):
+            self.assertNotIn(key, surrogate.__dict__)
+
+    def test_surrogates_hold_only_their_arguments(self):
+        surrogate = decorate(lambda cls: cls)
+        self.assertEqual(sorted(surrogate.__dict__),
+                         ['__doc__', '__module__', '__slots__', '_shape', 'args'])
+        self.assertEqual(surrogate.__basicsize__, object.__basicsize__)
+
+    def test_surrogates_share_their_shape(self):
+        first, second = decorate(lambda cls: cls), decorate(lambda cls: cls)
+        self.assertIsNot(first, second)
+        self.assertIs(first._shape, second._shape)
+
+class test_flatten(unittest.TestCase):
+    def setUp(self):
+        class Shape(metaclass(ABCMeta)):
+            def area(self):
+                return 0
+            def describe(self):
+                return 'shape'
+        class Rectangle(Shape):
+            def area(self):
+                return self.w * self.h
+        class Square(inherits(Rectangle), flatten()):
+            def describe(self):
+                return 'square'
+        self.Shape, self.Rectangle, self.Square = Shape, Rectangle, Square
+
+    def test_inherited_attributes_are_copied(self):
+        Square = self.Square
+        self.assertIs(Square.__dict__['area'], self.Rectangle.__dict__['area'])
+        self.assertEqual(Square().describe(), 'square')
+        self.assertTrue(issubclass(Square, self.Shape))
+        self.assertNotIn('__weakref__', Square.__dict__)
+        for key in ('_abc_impl', '_abc_registry'):
+            if key in self.Shape.__dict__:
+                self.assertIsNot(Square.__dict__[key], self.Shape.__dict__[key])
+
+    def test_only_named_attributes(self):
+        class Square(inherits(self.Rectangle), flatten('describe')):
+            pass
+        self.assertIn('describe', Square.__dict__)
+        self.assertNotIn('area', Square.__dict__)
+
+    def test_patching_a_base_reflattens(self):
+        scoped = patch_set()
+        scoped.add(self.Shape, {'describe': lambda self: 'patched'})
+        scoped.add(self.Rectangle, {'area': lambda self: -1})
+        with scoped:
+            self.assertEqual(self.Square().area(), -1)
+            self.assertEqual(self.Square().describe(), 'square')
+        self.assertIs(self.Square.__dict__['area'], self.Rectangle.__dict__['area'])
+
+    def test_reflatten_keeps_replaced_copies(self):
+        Square = self.Square
+        Square.area = lambda self: 'own'
+        self.Rectangle.perimeter = lambda self: 2 * (self.w + self.h)
+        try:
+            reflatten(Square)
+        finally:
+            del self.Rectangle.perimeter
+        self.assertIn('perimeter', Square.__dict__)
+        self.assertEqual(Square().area(), 'own')
+        self.assertRaises(TypeError, reflatten, self.Rectangle)
+
+class test_memoize(unittest.TestCase):
+    def make_class(self, **options):
+        calls = self.calls = []
+        class Person(BasePerson, memoize(['full_name', 'greet'], **options)):
+            def __init__(self, first_name, last_name):
+                self.first_name, self.last_name = first_name, last_name
+            def greet(self, greeting='Hello'):
+                calls.append(greeting)
+                return '%s %s' % (greeting, self.first_name)
+        return Person
+
+    def test_methods_and_inherited_properties_are_cached(self):
+        Person = self.make_class()
+        p = Person('Ada', 'Lovelace')
+        self.assertEqual([p.greet(), p.greet(), p.greet('Hi')], ['Hello Ada'] * 2 + ['Hi Ada'])
+        self.assertEqual(self.calls, ['Hello', 'Hi'])
+        self.assertEqual(p.full_name, 'Lovelace, Ada')
+        p.first_name = 'Augusta'
+        self.assertEqual(p.full_name, 'Lovelace, Ada')
+        self.assertEqual(BasePerson.full_name.fget(p), 'Lovelace, Augusta')
+        info = cache_info(Person)
+        self.assertEqual(info['greet']['hits'], 1)
+        self.assertEqual((info['full_name']['hits'], info['full_name']['misses']), (1, 1))
+
+    def test_bounds(self):
+        Person = self.make_class(maxsize=2)
+        p = Person('Ada', 'Lovelace')
+        for greeting in ('a', 'b', 'c', 'a'):
+            p.greet(greeting)
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'a'])
+        self.assertEqual(cache_info(Person)['greet']['size'], 2)
+        Person = self.make_class(ttl=0)
+        p = Person('Ada', 'Lovelace')
+        p.greet(), p.greet()
+        self.assertEqual(self.calls, ['Hello', 'Hello'])
+
+    def test_invalidate(self):
+        Person = self.make_class()
+        ada, alan = Person('Ada', 'Lovelace'), Person('Alan', 'Turing')
+        ada.greet(), alan.greet()
+        invalidate(ada, 'greet')
+        ada.greet(), alan.greet()
+        self.assertEqual(self.calls, ['Hello'] * 3)
+        invalidate(Person)
+        alan.greet()
+        self.assertEqual(len(self.calls), 4)
+        self.assertRaises(AttributeError, invalidate, Person, '__init__')
+
+    def test_slotted_classes(self):
+        class Point(memoize('norm')):
+            __slots__ = ('x', 'y')
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+            def norm(self):
+                return abs(self.x) + abs(self.y)
+        p = Point(3, -4)
+        self.assertEqual((p.norm(), p.norm()), (7, 7))
+        self.assertEqual(cache_info(Point)['norm']['hits'], 1)
+
+    def test_equal_instances_do_not_share_results(self):
+        class Pair(memoize('second')):
+            def __init__(self, a, b):
+                self.a, self.b = a, b
+            def __eq__(self, other):
+                return self.a == other.a
+            def __hash__(self):
+                return hash(self.a)
+            def second(self):
+                return self.b
+        self.assertEqual((Pair(1, 2).second(), Pair(1, 3).second()), (2, 3))
+
+    def test_results_die_with_the_instance(self):
+        Person = self.make_class(maxsize=None)
+        p = Person('Ada', 'Lovelace')
+        ref = weakref.ref(p)
+        p.greet()
+        del p
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertEqual(cache_info(Person)['greet']['size'], 0)
+
+    def test_patched_classes(self):
+        Person = self.make_class()
+        p = Person('Ada', 'Lovelace')
+        p.greet()
+        class Person(patches(Person), memoize('shout')):
+            def shout(self):
+                return self.greet().upper()
+        self.assertEqual(cache_info(Person)['greet']['size'], 0)
+        self.assertEqual((p.shout(), p.shout()), ('HELLO ADA', 'HELLO ADA'))
+        self.assertEqual(cache_info(Person)['shout']['hits'], 1)
+
+    def test_namedtuples(self):
+        Person = namedtuple('Person', ('first_name', 'last_name'))
+        class Person(patches(Person), memoize('full_name')):
+            @property
+            def full_name(self):
+                return '%s %s' % self
+        p = Person('Ada', 'Lovelace')
+        self.assertEqual((p.full_name, p.full_name), ('Ada Lovelace',) * 2)
+        self.assertEqual(cache_info(Person)['full_name']['hits'], 1)
+        class Named(Person, memoize('initials', maxsize=1)):
+            __slots__ = ()
+            def initials(self):
+                return self.first_name[0] + self.last_name[0]
+        a, b = Named('Ada', 'Lovelace'), Named('Alan', 'Turing')
+        self.assertEqual([a.initials(), a.initials(), b.initials()], ['AL', 'AL', 'AT'])
+        self.assertEqual(cache_info(Named)['initials']['size'], 1)
+        self.assertEqual(Named.__slots__, ())
+
+    def test_only_methods_and_properties(self):
+        def build():
+            class Thing(memoize('x')):
+                x = 1
+        self.assertRaises(TypeError, build)
+        def build():
+            class Thing(memoize('missing')):
+                pass
+        self.assertRaises(TypeError, build)
+
+class test_columnar(unittest.TestCase):
+    def setUp(self):
+        Point = namedtuple('Point', ('x', 'y', 'label'))
+        class Point(patches(Point)):
+            def norm(self):
+                return abs(self.x) + abs(self.y)
+        self.Point = Point
+        self.Points = columnar(Point, {'x': 'd', 'y': 'd'})
+        self.table = self.Points(Point(i, -i, str(i)) for i in range(5))
+
+    def test_columns(self):
+        table = self.table
+        self.assertEqual(len(table), 5)
+        self.assertEqual(table.x.typecode, 'd')
+        self.assertEqual(sum(table.y), -10)
+        self.assertEqual(table.label, ['0', '1', '2', '3', '4'])
+
+    def test_rows_are_records_with_patched_methods(self):
+        table = self.table
+        table.append(self.Point(7, 7, 'seven'))
+        self.assertEqual(table[-1], self.Point(7, 7, 'seven'))
+        self.assertEqual([row.norm() for row in table], [0, 2, 4, 6, 8, 14])
+
+    def test_failed_rows_leave_the_columns_aligned(self):
+        table, Point = self.table, self.Point
+        self.assertRaises(TypeError, table.append, Point(3.0, 'bad', 'three'))
+        self.assertRaises(TypeError, table.extend,
+                          [Point(5, 5, 'five'), Point(6, 'bad', 'six')])
+        self.assertEqual((len(table.x), len(table.y), len(table.label)), (5, 5, 5))
+        self.assertEqual(table[-1], Point(4, -4, '4'))
+
+    def test_slices_are_containers(self):
+        part = self.table[1:3]
+        self.assertIsInstance(part, self.Points)
+        self.assertEqual(list(part.label), ['1', '2'])
+
+    def test_records_without_fields(self):
+        class Person(inherits(BasePerson)):
+            def __init__(self, first_name, last_name):
+                self.first_name, self.last_name = first_name, last_name
+        self.assertRaises(TypeError, columnar, Person)
+        People = columnar(Person, fields=('first_name', 'last_name'))
+        people = People([Person('Ada', 'Lovelace')])
+        self.assertEqual(people[0].full_name, 'Lovelace, Ada')
+        self.assertRaises(TypeError, columnar, Person, fields=('append',))
+
+    def test_numpy_columns_share_memory(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('numpy is not installed')
+        x = self.table.column('x', numpy=True)
+        self.assertEqual(x.sum(), 10)
+        self.table.x[0] = 100
+        self.assertEqual(x[0], 100)
+
+class test_tracked_includes(unittest.TestCase):
+    def setUp(self):
+        class Base(object):
+            def kind(self):
+                return 'base'
+        class Warranty(Base):
+            def claim(self):
+                return 'warranty'
+            def cover(self):
+                return 'warranty'
+        class Insurance(object):
+            def cover(self):
+                return 'insurance'
+        class Car(includes([Warranty, Insurance], track=True)):
+            def claim(self):
+                return 'car'
+        self.Base, self.Warranty, self.Insurance, self.Car = Base, Warranty, Insurance, Car
+
+    def test_patches_are_pushed_to_consumers(self):
+        class Warranty(patches(self.Warranty)):
+            def cover(self):
+                return 'fixed'
+            def renew(self):
+                return 'renewed'
+        car = self.Car()
+        self.assertEqual((car.cover(), car.renew()), ('fixed', 'renewed'))
+        self.assertEqual(car.claim(), 'warranty')
+
+    def test_overrides_and_left_priority_are_respected(self):
+        self.Car.claim = lambda self: 'own'
+        scoped = patch_set()
+        scoped.add(self.Warranty, {'claim': lambda self: 'fixed'})
+        scoped.add(self.Insurance, {'cover': lambda self: 'fixed'})
+        with scoped:
+            self.assertEqual((self.Car().claim(), self.Car().cover()), ('own', 'warranty'))
+
+    def test_reverting_restores_consumers(self):
+        scoped = patch_set()
+        scoped.add(self.Base, {'kind': lambda self: 'fixed'})
+        with scoped:
+            self.assertEqual(self.Car().kind(), 'fixed')
+        self.assertEqual(self.Car().kind(), 'base')
+
+    def test_propagate_direct_changes(self):
+        self.Warranty.transfer = lambda self: 'transferred'
+        del self.Warranty.cover
+        propagate(self.Warranty)
+        car = self.Car()
+        self.assertEqual((car.transfer(), car.cover()), ('transferred', 'insurance'))
+
+    def test_consumers_of_consumers(self):
+        class Truck(includes(self.Car, track=True)):
+            pass
+        class Warranty(patches(self.Warranty)):
+            def cover(self):
+                return 'fixed'
+        self.assertEqual(Truck().cover(), 'fixed')
+        self.assertIsNot(Truck.__dict__['__included__'], self.Car.__dict__['__included__'])
+
+    def test_consumers_are_weak(self):
+        consumers = class_helpers._consumers[self.Warranty]
+        del self.Car
+        gc.collect()
+        self.assertEqual(len(consumers), 0)
+
+    def test_cannot_be_lazy(self):
+        self.assertRaises(TypeError, includes, self.Warranty, lazy=True, track=True)
+
+class test_profile(unittest.TestCase):
+    source = (
+        'from class_helpers import includes, py3\n'
+        'from abc import ABCMeta\n'
+        'class Mixin(object):\n'
+        '    a, b = 1, 2\n'
+        'class Thing(includes(Mixin)):\n'
+        '    pass\n'
+        'class Other(py3(object, metaclass=ABCMeta)):\n'
+        '    pass\n')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        package = os.path.join(self.directory, 'profiled_pkg')
+        os.mkdir(package)
+        with open(os.path.join(package, '__init__.py'), 'w') as f:
+            f.write('')
+        with open(os.path.join(package, 'models.py'), 'w') as f:
+            f.write(self.source)
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        for name in ('profiled_pkg', 'profiled_pkg.models'):
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.directory)
+
+    def test_profiles_every_module_in_the_tree(self):
+        from class_helpers import profile
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            profile.main(['profiled_pkg', '--json'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        report = json.loads(output)
+        classes = dict((record['class'], record) for record in report['classes'])
+        thing = classes['profiled_pkg.models.Thing']
+        self.assertGreaterEqual(thing['attributes']['includes_attributes'], 2)
+        self.assertEqual(set(thing['helpers']), {'includes'})
+        other = classes['profiled_pkg.models.Other']
+        self.assertEqual(other['helpers_used'], ['py6'])
+        self.assertEqual(set(other['helpers']), {'inherits', 'metaclass', 'py6'})
+        self.assertEqual(report['total']['classes'], 2)
+        self.assertIsNone(instrumentation_snapshot())
+
+class test_lazy_classes(unittest.TestCase):
+    def setUp(self):
+        built = self.built = []
+        def record(cls):
+            built.append(cls)
+            return cls
+        class Base(object):
+            def greet(self):
+                return 'base'
+        class Plugin(lazy(), decorate(record), Base):
+            ''' A plugin '''
+            def greet(self):
+                return 'plugin ' + Base.greet(self)
+        self.Base, self.Plugin = Base, Plugin
+
+    @unittest.skipIf(sys.version_info < (3, 7), "lazy() builds at once before 3.7")
+    def test_building_waits_for_first_use(self):
+        Plugin = self.Plugin
+        self.assertEqual((Plugin.__name__, self.built), ('Plugin', []))
+        self.assertIn('lazy class', repr(Plugin))
+        self.assertEqual(Plugin().greet(), 'plugin base')
+        self.assertEqual(len(self.built), 1)
+        self.assertIsInstance(force(Plugin), type)
+        # Python 3.13 strips the indentation of docstrings
+        self.assertEqual(Plugin.__doc__.strip(), 'A plugin')
+
+    def test_type_checks_force_the_class(self):
+        self.assertTrue(issubclass(self.Plugin, self.Base))
+        instance = force(self.Plugin)()
+        self.assertIsInstance(instance, self.Plugin)
+        self.assertTrue(issubclass(type(instance), self.Plugin))
+
+    def test_subclassing_forces_the_class(self):
+        class Special(self.Plugin):
+            pass
+        self.assertEqual(Special().greet(), 'plugin base')
+        self.assertEqual(len(self.built), 1)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "lazy() builds at once before 3.7")
+    def test_force_all(self):
+        self.assertGreaterEqual(force_all(), 1)
+        self.assertEqual(len(self.built), 1)
+        self.assertEqual(force_all(), 0)
+
+    def test_module_names_are_rebound(self):
+        module = types.ModuleType('lazy_module')
+        sys.modules['lazy_module'] = module
+        try:
+            exec('from class_helpers import lazy\n'
+                 'class Thing(lazy()):\n'
+                 '    x = 1\n', module.__dict__)
+            self.assertEqual(module.Thing.x, 1)
+            self.assertIsInstance(module.Thing, type)
+        finally:
+            del sys.modules['lazy_module']
+
+class test_class_cache(unittest.TestCase):
+    class Mixin(object):
+        def method(self):
+            return 'mixin'
+
+    def build(self, cache, name='Handler', **dct):
+        return cache.build(name, (includes(self.Mixin), metaclass(ABCMeta)), dct)
+
+    def test_identical_specs_share_a_class(self):
+        cache = class_cache()
+        Handler = self.build(cache, x=1, label='a')
+        self.assertIs(self.build(cache, x=1, label='a'), Handler)
+        self.assertIsNot(self.build(cache, x=2, label='a'), Handler)
+        self.assertIsNot(self.build(cache, x=True, label='a'), Handler)
+        self.assertIsNot(self.build(cache, 'Other', x=1, label='a'), Handler)
+        self.assertEqual(Handler().method(), 'mixin')
+        info = cache.info()
+        self.assertEqual((info['hits'], info['misses']), (1, 4))
+
+    def test_namespace_objects_compare_by_identity(self):
+        cache = class_cache()
+        handler = lambda self: None
+        Handler = self.build(cache, handle=handler)
+        self.assertIs(self.build(cache, handle=handler), Handler)
+        self.assertIsNot(self.build(cache, handle=lambda self: None), Handler)
+
+    def test_side_effects_are_never_cached(self):
+        cache = class_cache()
+        Target = type('Target', (object,), {})
+        cache.build('Target', (patches(Target),), {'x': 1})
+        self.assertEqual((Target.x, cache.info()['uncached']), (1, 1))
+
+    def test_steady_state_memory_is_bounded(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            raise unittest.SkipTest('tracemalloc is not available')
+        cache = class_cache(maxsize=8)
+        def churn(rounds):
+            for i in range(rounds):
+                self.build(cache, 'Handler%d' % (i % 16), x=i % 16)
+        churn(64)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            churn(2000)
+            gc.collect()
+            growth = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        self.assertLess(growth, 64 * 1024)
+        self.assertLessEqual(cache.info()['alive'], 16)
+        self.assertEqual(cached_class('Same', (object,), {}), cached_class('Same', (object,), {}))
+
+    def test_fresh_mixins_are_not_kept_by_hits(self):
+        cache = class_cache(maxsize=16)
+        before = len(class_helpers._interned)
+        for i in range(500):
+            mixin = type('Mixin%d' % i, (object,), {'i': i})
+            for _ in range(2):
+                cache.build('Handler', (includes(mixin), includes([mixin])), {})
+        del mixin
+        gc.collect() # Collects the classes evicted from the cache
+        gc.collect() # Then their surrogates and mixins
+        self.assertLessEqual(len(class_helpers._interned) - before, 2 * 16)
+
+    def test_hits_release_helper_arguments(self):
+        cache = class_cache(maxsize=0)
+        mixin = type('Mixin', (object,), {})
+        first = cache.build('Handler', (includes(mixin),), {})
+        self.assertIs(cache.build('Handler', (includes(mixin),), {}), first)
+        ref = weakref.ref(mixin)
+        del mixin, first
+        gc.collect()
+        gc.collect()
+        self.assertIsNone(ref())
+
+class test_finalize(unittest.TestCase):
+    def tearDown(self):
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    def test_releases_internal_state(self):
+        class Mixin(object):
+            a = 1
+        class Pending(lazy(), includes(Mixin)):
+            pass
+        released = finalize()
+        if sys.version_info >= (3, 7):
+            # Earlier versions build lazy() classes at once
+            self.assertGreaterEqual(released['lazy_classes'], 1)
+        self.assertGreaterEqual(released['mixin_plans'], 1)
+        self.assertEqual((len(class_helpers._interned), len(class_helpers._mixin_plans)), (0, 0))
+        self.assertEqual(Pending.a, 1)
+        class Later(includes(Mixin)):
+            pass
+        self.assertEqual(Later.a, 1)
+
+    def test_stored_helpers_still_work(self):
+        class Base(object):
+            pass
+        class Mixin(object):
+            a = 1
+        helper = py3(Base, metaclass=ABCMeta, includes=Mixin)
+        class A(helper):
+            pass
+        finalize(freeze=False)
+        class B(helper):
+            pass
+        self.assertEqual((A.a, B.a), (1, 1))
+        self.assertTrue(issubclass(B, Base))
+
+    @staticmethod
+    def private_dirty_kb():
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Private_Dirty:'):
+                    return int(line.split()[1])
+
+    def collect_in_child(self):
+        """ Private memory a forked child dirties by collecting garbage """
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read)
+                before = self.private_dirty_kb()
+                gc.collect()
+                os.write(write, str(self.private_dirty_kb() - before).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        try:
+            return int(os.read(read, 64))
+        finally:
+            os.close(read)
+            os.waitpid(pid, 0)
+
+    def test_forked_children_share_more_memory(self):
+        if not hasattr(os, 'fork') or not hasattr(gc, 'freeze'):
+            raise unittest.SkipTest('needs os.fork and gc.freeze')
+        if not os.path.exists('/proc/self/smaps_rollup'):
+            raise unittest.SkipTest('needs /proc/self/smaps_rollup')
+        class Mixin(object):
+            def method(self):
+                return self
+        classes = [type('Built%d' % i, (includes(Mixin), metaclass(ABCMeta)),
+                        {'values': [i]}) for i in range(1000)]
+        before = self.collect_in_child()
+        finalize()
+        after = self.collect_in_child()
+        self.assertLess(after, before / 2.0)
+        self.assertEqual(len(classes), 1000)
+
+class test_record(unittest.TestCase):
+    class FullName(object):
+        @property
+        def full_name(self):
+            return ', '.join([self.last_name, self.first_name])
+
+    def setUp(self):
+        class Person(record(['first_name', 'last_name']), includes(self.FullName),
+                     metaclass(ABCMeta)):
+            last_name = 'Doe'
+        self.Person = Person
+
+    def test_generated_methods(self):
+        Person = self.Person
+        p = Person('Steve', 'Zelaznik')
+        self.assertEqual(repr(p), "Person(first_name='Steve', last_name='Zelaznik')")
+        self.assertEqual(p, Person('Steve', 'Zelaznik'))
+        self.assertNotEqual(p, Person('Steve'))
+        self.assertEqual(hash(p), hash(Person('Steve', 'Zelaznik')))
+        self.assertEqual((len(p), list(p), p[1]), (2, ['Steve', 'Zelaznik'], 'Zelaznik'))
+        self.assertIn('Zelaznik', p)
+        self.assertEqual(Person('Jane').last_name, 'Doe')
+        self.assertEqual(Person.__init__.__qualname__.split('.')[-2:], ['Person', '__init__'])
+
+    def test_composes_with_includes_and_metaclass(self):
+        p = self.Person('Steve', 'Zelaznik')
+        self.assertEqual(p.full_name, 'Zelaznik, Steve')
+        self.assertIsInstance(self.Person, ABCMeta)
+        self.assertEqual(self.Person.__slots__, ('first_name', 'last_name'))
+        self.assertFalse(hasattr(p, '__dict__'))
+
+    def test_body_methods_win(self):
+        class Point(record('x')):
+            def __eq__(self, other):
+                return True
+        self.assertEqual(Point(1), Point(2))
+        # None on Python 3, inherited from object on Python 2
+        self.assertIsNone(Point.__dict__.get('__hash__'))
+
+    def test_patched_classes_keep_their_layout(self):
+        class Person(object):
+            pass
+        original = Person
+        class Person(patches(Person), record(['first_name', 'last_name'])):
+            pass
+        self.assertIs(Person, original)
+        p = Person('Steve', 'Zelaznik')
+        p.nickname = 'Z'
+        self.assertEqual(p, Person('Steve', 'Zelaznik'))
+
+    def test_invalid_fields(self):
+        for fields in (['a', 'a'], ['class'], ['__x'], ['not valid'], ['self', 'y']):
+            self.assertRaises(TypeError, lambda: type('Bad', (record(fields),), {}))
+        def build():
+            class Bad(record(['a', 'b'])):
+                a = 1
+        self.assertRaises(TypeError, build)
+
+class test_hot_reload(unittest.TestCase):
+    before = (
+        'def logged(func):\n'
+        '    def wrapper(self):\n'
+        '        return func(self)\n'
+        '    return wrapper\n'
+        'class Base(object):\n'
+        '    def greet(self):\n'
+        '        return "base"\n'
+        'class Point(Base):\n'
+        '    def norm(self):\n'
+        '        return 1\n'
+        '    def greet(self):\n'
+        '        return "point"\n'
+        '    def old(self):\n'
+        '        return "old"\n'
+        '    @logged\n'
+        '    def value(self):\n'
+        '        return 1\n'
+        '    @logged\n'
+        '    def same(self):\n'
+        '        return 1\n'
+        'class Line(object):\n'
+        '    pass\n'
+        'class Pair(object):\n'
+        '    __slots__ = ("x", "y")\n'
+        '    def total(self):\n'
+        '        return self.x + self.y\n')
+    # Python 2 has no zero argument super(), nor the __class__ cell it uses
+    _super = 'super()' if sys.version_info[0] >= 3 else 'super(Point, self)'
+    after = (
+        '# A comment moving every line down\n'
+        'def logged(func):\n'
+        '    def wrapper(self):\n'
+        '        return func(self)\n'
+        '    return wrapper\n'
+        'class Base(object):\n'
+        '    def greet(self):\n'
+        '        return "base"\n'
+        'class Point(Base):\n'
+        '    def norm(self):\n'
+        '        return 1\n'
+        '    def greet(self):\n'
+        '        return "fixed " + %s.greet() + str(isinstance(self, Point))\n'
+        '    @logged\n'
+        '    def value(self):\n'
+        '        return 2\n'
+        '    @logged\n'
+        '    def same(self):\n'
+        '        return 1\n'
+        'class Line(Base):\n'
+        '    pass\n'
+        'class Pair(object):\n'
+        '    __slots__ = ("x", "y")\n'
+        '    def total(self):\n'
+        '        return self.x * self.y\n'
+        'class Circle(object):\n'
+        '    pass\n') % _super
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'reloaded_module.py')
+        with open(self.path, 'w') as f:
+            f.write(self.before)
+        sys.path.insert(0, self.directory)
+        import reloaded_module
+        self.module = reloaded_module
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        sys.modules.pop('reloaded_module', None)
+        shutil.rmtree(self.directory)
+
+    def test_only_changed_attributes_are_patched(self):
+        module = self.module
+        Point, point = module.Point, module.Point()
+        pair = module.Pair()
+        pair.x, pair.y = 2, 3
+        with open(self.path, 'w') as f:
+            f.write(self.after)
+        report = hot_reload(module)
+        self.assertEqual(report['patched'], {'Point': ['greet', 'value'],
+                                             'Pair': ['total']})
+        self.assertEqual(report['stale'], {'Point': ['old']})
+        self.assertEqual(report['skipped'], {'Line': 'bases changed'})
+        self.assertEqual(report['added'], ['Circle'])
+        self.assertIs(module.Point, Point)
+        self.assertEqual(point.greet(), 'fixed baseTrue')
+        self.assertEqual(point.value(), 2)
+        self.assertEqual(pair.total(), 6)
+        self.assertEqual(hot_reload('reloaded_module')['patched'], {})
+
+class Area(object):
+    def area(self):
+        return self.width * self.height
+
+def make_shape(kind):
+    # Built at run time, so the class cannot be imported by name
+    return type('Shape', (portable(), includes(Area)), {'kind': kind})
+
+def shape_area(shape):
+    return shape.kind, shape.area()
+
+def reduce_to_pair(self):
+    return (tuple, ((1, 2),))
+
+class test_portable(unittest.TestCase):
+    def setUp(self):
+        self.Shape = make_shape('square')
+        self.shape = self.Shape()
+        self.shape.width = self.shape.height = 3
+
+    def forget(self, cls):
+        # As if unpickling in a process which never built the class
+        digest = cls.__portable__.digest
+        class_helpers._portable_classes.pop(digest)
+        self.addCleanup(class_helpers._rebuilt_classes.pop, digest, None)
+
+    def test_round_trip_keeps_the_class(self):
+        copy = pickle.loads(pickle.dumps(self.shape))
+        self.assertIs(type(copy), self.Shape)
+        self.assertEqual(copy.area(), 9)
+
+    def test_class_is_rebuilt_once_from_its_spec(self):
+        data = pickle.dumps([self.shape, self.shape])
+        self.forget(self.Shape)
+        first, second = pickle.loads(data)
+        self.assertIs(first, second)
+        Rebuilt = type(first)
+        self.assertIsNot(Rebuilt, self.Shape)
+        self.assertEqual(Rebuilt.__name__, self.Shape.__name__)
+        self.assertEqual(getattr(Rebuilt, '__qualname__', None),
+                         getattr(self.Shape, '__qualname__', None))
+        self.assertEqual(shape_area(first), ('square', 9))
+        self.assertIs(type(pickle.loads(data)[0]), Rebuilt)
+
+    def test_portable_bases_are_rebuilt_too(self):
+        Cube = type('Cube', (portable(), self.Shape), {'depth': 2})
+        cube = Cube()
+        cube.width = cube.height = 2
+        data = pickle.dumps(cube)
+        self.forget(Cube)
+        self.forget(self.Shape)
+        copy = pickle.loads(data)
+        self.assertEqual((copy.area(), copy.depth), (4, 2))
+        self.assertIsNot(type(copy), Cube)
+
+    def test_own_reduce_wins(self):
+        Pair = type('Pair', (portable(),), {'__reduce__': reduce_to_pair})
+        self.assertEqual(pickle.loads(pickle.dumps(Pair())), (1, 2))
+
+    def test_unpicklable_spec_raises_error(self):
+        def method(self):
+            pass
+        with self.assertRaises(TypeError):
+            type('Local', (portable(),), {'method': method})
+        with self.assertRaises(TypeError):
+            class Patched(portable(), patches(Area)):
+                pass
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_process_pool(self):
+        import multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            pool = multiprocessing.get_context('fork').Pool(2)
+        else:
+            pool = multiprocessing.Pool(2)
+        try:
+            results = pool.map(shape_area, [self.shape] * 4)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(results, [('square', 9)] * 4)
+
+class test_memory_residue(unittest.TestCase):
+    """ Building and discarding classes over and over, as long running
+        processes generating classes do, must leave nothing behind.
+        A class kept alive costs well over a kilobyte.
+    """
+    number = 1000
+
+    def setUp(self):
+        class Base(object):
+            pass
+        class Mixin(object):
+            x = 1
+            def method(self):
+                return self.x
+        self.Base, self.Mixin = Base, Mixin
+        self.Target = type('Target', (object,), {})
+
+    def check(self, build):
+        found = residue(build, self.number)
+        if found['bytes'] is not None:
+            self.assertLess(found['bytes'], 256)
+        self.assertLess(found['objects'], 0.1)
+        self.assertEqual(self.Base.__subclasses__(), [])
+        return found
+
+    def test_harness_finds_leaks(self):
+        kept = []
+        found = residue(lambda i: kept.append(type('Kept', (object,), {})), self.number)
+        self.assertGreater(found['objects'], 1)
+        if found['bytes'] is not None:
+            self.assertGreater(found['bytes'], 256)
+
+    def test_includes(self):
+        def build(i):
+            mixin = type('Mixin', (self.Mixin,), {'y': i})
+            cls = type('Included', (self.Base, includes([mixin, self.Mixin])), {})
+            cls().method()
+        self.check(build)
+
+    def test_lazy_includes(self):
+        def build(i):
+            mixin = type('Mixin', (self.Mixin,), {'y': i})
+            cls = type('Included', (self.Base, includes(mixin, lazy=True)), {})
+            cls().method()
+        self.check(build)
+
+    def test_patches(self):
+        def build(i):
+            target = type('Target', (object,), {})
+            type('Target', (patches(target),), {'i': i})
+            type('Target', (patches(self.Target),), {'i': i})
+        self.check(build)
+
+    def test_decorate(self):
+        def build(i):
+            def decorator(namespace):
+                namespace.i = i
+                return namespace
+            type('Decorated', (self.Base, decorate([decorator, wraps(self.Mixin)])), {})
+        self.check(build)
+
+    def test_py6(self):
+        def build(i):
+            cls = type('Py3', (py3(self.Base, metaclass=ABCMeta, includes=self.Mixin),), {})
+            isinstance(cls(), cls)
+            issubclass(self.Mixin, cls)
+            type('Py2', (py2(self.Base, includes=self.Mixin),), {'__metaclass__': ABCMeta})
+        self.check(build)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file